@@ -0,0 +1,582 @@
+# Copyright 2012 Ross Lagerwall
+# This file is part of gizz.
+
+# gizz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# gizz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with gizz.  If not, see <http://www.gnu.org/licenses/>.
+
+# A local stand-in for the parts of the GitHub API used by gizz, serving
+# generated fixtures. Point gizz at it with GIZZ_API_URL.
+
+import argparse
+import gzip
+import hashlib
+import http.server
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+OWNER = 'owner'
+REPO = 'project'
+USERNAME = 'me'
+
+
+class Fixtures:
+
+    def __init__(self, prs=500, forks=50, tags=1000, branches=200, repos=100,
+                 comments=5, git_dir=None, mergeable_delay=0.0,
+                 tarball_size=1024 * 1024):
+        self.num_prs = prs
+        self.num_forks = forks
+        self.num_tags = tags
+        self.num_branches = branches
+        self.num_repos = repos
+        self.num_comments = comments
+        self.git_dir = git_dir
+        self.upstream_path = None
+        self.head_shas = {}
+        self.merged = set()
+        # like GitHub, mergeability is null until it has been worked out in
+        # the background, taking this many seconds from the first request
+        self.mergeable_delay = mergeable_delay
+        self.mergeable_requested = {}
+        self.tarball_size = tarball_size
+        # requests for archives that came with a token, which they shouldn't
+        self.tarball_auth = 0
+        if git_dir is not None:
+            self._make_git_repos()
+
+    def _make_git_repos(self):
+        # one bare repository holding master, a feature-<id> branch for each
+        # pull request and refs/pull/<id>/head; every fork is a symlink to it
+        # so that each one has a distinct URL
+        self.upstream_path = os.path.join(self.git_dir, 'upstream.git')
+        subprocess.check_call(['git', 'init', '-q', '--bare',
+                               self.upstream_path])
+        stream = []
+        def commit(ref, mark, message, parent=None):
+            stream.append('commit {}\nmark :{}\n'.format(ref, mark))
+            stream.append('committer Bench <bench@example.com> '
+                          '1700000000 +0000\n')
+            stream.append('data {}\n{}\n'.format(len(message), message))
+            if parent is not None:
+                stream.append('from :{}\n'.format(parent))
+            stream.append('M 644 inline {}\ndata {}\n{}\n'.format(
+                    'file-{}'.format(mark), len(message), message))
+        commit('refs/heads/master', 1, 'initial commit')
+        for i in range(1, self.num_prs + 1):
+            commit('refs/heads/feature-{}'.format(i), i + 1,
+                   'pull request {}'.format(i), parent=1)
+            stream.append('reset refs/pull/{}/head\nfrom :{}\n\n'.format(
+                    i, i + 1))
+        subprocess.run(['git', '--git-dir', self.upstream_path, 'fast-import',
+                        '--quiet'], input=''.join(stream).encode(),
+                       check=True)
+        subprocess.check_call(['git', '--git-dir', self.upstream_path,
+                               'symbolic-ref', 'HEAD', 'refs/heads/master'])
+
+        output = subprocess.check_output(
+            ['git', '--git-dir', self.upstream_path, 'for-each-ref',
+             '--format=%(refname) %(objectname)', 'refs/heads/']).decode()
+        for line in output.splitlines():
+            ref, sha = line.split()
+            self.head_shas[ref[len('refs/heads/'):]] = sha
+
+        for k in range(self.num_forks):
+            os.symlink(self.upstream_path, self.get_fork_path(k))
+
+    def get_fork_path(self, k):
+        if self.git_dir is None:
+            return '/nonexistent/{}.git'.format(self.get_fork_user(k))
+        return os.path.join(self.git_dir, 'fork-{}.git'.format(k))
+
+    def get_fork_user(self, k):
+        return 'user{:04d}'.format(k)
+
+    def get_sha(self, name):
+        if name in self.head_shas:
+            return self.head_shas[name]
+        return hashlib.sha1(name.encode()).hexdigest()
+
+    def get_user(self, login):
+        return {'login': login, 'name': login.title(), 'following': 0}
+
+    def get_repo(self, login, name):
+        if login == OWNER and name == REPO and self.upstream_path is not None:
+            git_url = clone_url = self.upstream_path
+        elif login.startswith('user') and login[4:].isdigit():
+            git_url = clone_url = self.get_fork_path(int(login[4:]))
+        else:
+            git_url = 'git://github.com/{}/{}.git'.format(login, name)
+            clone_url = 'https://github.com/{}/{}.git'.format(login, name)
+        data = {'name': name,
+                'owner': {'login': login},
+                'git_url': git_url,
+                'clone_url': clone_url,
+                'ssh_url': 'git@github.com:{}/{}.git'.format(login, name),
+                'description': 'Repository {}/{}'.format(login, name),
+                'fork': login != OWNER}
+        if login != OWNER:
+            parent = self.get_repo(OWNER, name)
+            data['parent'] = parent
+        return data
+
+    def get_repo_list(self, login):
+        return [self.get_repo(login, 'repo{:04d}'.format(i))
+                for i in range(self.num_repos)]
+
+    def get_branch_list(self):
+        names = ['master'] + ['branch-{}'.format(i)
+                              for i in range(1, self.num_branches)]
+        return [{'name': name, 'commit': {'sha': self.get_sha(name)}}
+                for name in names]
+
+    def get_tag_list(self):
+        return [{'name': 'v{}.{}'.format(i // 100, i % 100),
+                 'commit': {'sha': self.get_sha('tag-{}'.format(i))},
+                 'tarball_url': 'https://api.github.com/repos/{}/{}/tarball/'
+                 'v{}.{}'.format(OWNER, REPO, i // 100, i % 100)}
+                for i in range(self.num_tags)]
+
+    def _get_date(self, seconds):
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+    def get_pull_request(self, id, detail=False):
+        if id < 1 or id > self.num_prs:
+            return None
+        k = id % self.num_forks if self.num_forks else 0
+        user = self.get_fork_user(k)
+        head_ref = 'feature-{}'.format(id)
+        data = {'number': id,
+                'state': 'closed' if id % 5 == 0 or id in self.merged
+                         else 'open',
+                'title': 'Pull request {}'.format(id),
+                'body': 'Description of pull request {}.\n'.format(id) * 3,
+                'user': {'login': user},
+                'created_at': self._get_date(1700000000 + id * 3600),
+                'updated_at': self._get_date(1700000000 + id * 7200),
+                'head': {'user': {'login': user},
+                         'repo': self.get_repo(user, REPO),
+                         'ref': head_ref,
+                         'sha': self.get_sha(head_ref)},
+                'base': {'user': {'login': OWNER},
+                         'repo': self.get_repo(OWNER, REPO),
+                         'ref': 'master',
+                         'sha': self.get_sha('master')}}
+        if detail:
+            data['merged'] = id in self.merged
+            requested = self.mergeable_requested.setdefault(id, time.time())
+            if data['state'] != 'open':
+                # GitHub doesn't work it out for closed pull requests
+                data['mergeable'] = None
+            elif time.time() - requested < self.mergeable_delay:
+                data['mergeable'] = None
+            else:
+                data['mergeable'] = id % 3 != 0
+        return data
+
+    def get_pull_request_list(self, state):
+        prs = []
+        for id in range(self.num_prs, 0, -1):
+            pr = self.get_pull_request(id)
+            if state == 'all' or pr['state'] == state:
+                prs.append(pr)
+        return prs
+
+    def get_comments(self, id):
+        return [{'id': id * 1000 + i,
+                 'issue_url': 'https://api.github.com/repos/{}/{}/issues/'
+                 '{}'.format(OWNER, REPO, id),
+                 'user': {'login': self.get_fork_user(i)},
+                 'body': 'Comment {} on pull request {}.'.format(i, id),
+                 'created_at': self._get_date(1700000000 + id * 3600 + i),
+                 'updated_at': self._get_date(1700000000 + id * 3600 + i)}
+                for i in range(id % (self.num_comments + 1))]
+
+    def get_tarball(self, ref):
+        # stands in for a generated archive, different for each ref
+        block = hashlib.sha256(ref.encode()).digest() * 128
+        return (block * (self.tarball_size // len(block) + 1))[
+                :self.tarball_size]
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    routes = [
+        ('GET', r'/users/(\w+)', 'user'),
+        ('GET', r'/users/(\w+)/repos', 'repo_list'),
+        ('GET', r'/orgs/(\w+)', 'user'),
+        ('GET', r'/orgs/(\w+)/repos', 'repo_list'),
+        ('GET', r'/repos/(\w+)/(\w+)', 'repo'),
+        ('GET', r'/repos/(\w+)/(\w+)/branches', 'branch_list'),
+        ('GET', r'/repos/(\w+)/(\w+)/tags', 'tag_list'),
+        ('GET', r'/repos/(\w+)/(\w+)/pulls', 'pull_request_list'),
+        ('GET', r'/repos/(\w+)/(\w+)/pulls/(\d+)', 'pull_request'),
+        ('GET', r'/repos/(\w+)/(\w+)/issues/(\d+)/comments', 'comments'),
+        ('GET', r'/repos/(\w+)/(\w+)/issues/comments', 'repo_comments'),
+        ('PUT', r'/repos/(\w+)/(\w+)/pulls/(\d+)/merge', 'merge'),
+        ('POST', r'/repos/(\w+)/(\w+)/forks', 'fork'),
+        ('POST', r'/repos/(\w+)/(\w+)/pulls', 'create_pull_request'),
+        ('POST', r'/graphql', 'graphql'),
+        ('GET', r'/repos/(\w+)/(\w+)/tarball/(.+)', 'tarball'),
+        ('GET', r'/codeload/(\w+)/(\w+)/legacy\.tar\.gz/(.+)', 'codeload'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def _dispatch(self, method):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        server.count_request(len(self.requestline) + length)
+        fault = self._fault = server.pick_fault()
+        if fault == 'error':
+            self._send_json(502, {'message': 'Bad Gateway'})
+            return
+        if server.latency:
+            time.sleep(server.latency)
+        if fault == 'slow':
+            time.sleep(server.slow_latency)
+
+        url = urllib.parse.urlsplit(self.path)
+        self._query = dict(urllib.parse.parse_qsl(url.query))
+        self._body = json.loads(body.decode()) if body else None
+        for route_method, pattern, name in self.routes:
+            m = re.fullmatch(pattern, url.path)
+            if m and route_method == method:
+                getattr(self, 'handle_' + name)(*m.groups())
+                return
+        self._send_json(404, {'message': 'Not Found'})
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            status = 304
+            body = b''
+        elif 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, 1)
+            headers = dict(headers or {}, **{'Content-Encoding': 'gzip'})
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        limit, remaining, reset = self.server.get_rate_limit()
+        self.send_header('X-RateLimit-Limit', str(limit))
+        self.send_header('X-RateLimit-Remaining', str(remaining))
+        self.send_header('X-RateLimit-Reset', str(reset))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self._send_body(body)
+
+    def _send_body(self, body):
+        if self._fault == 'drop':
+            # cut off part way through
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        self.wfile.write(body)
+        self.server.count_response(len(body))
+
+    def _send_page(self, items):
+        # paginate like GitHub, with Link headers pointing at the next page
+        per_page = min(int(self._query.get('per_page', 30)), 100)
+        page = int(self._query.get('page', 1))
+        start = (page - 1) * per_page
+        headers = {}
+        if start + per_page < len(items):
+            query = dict(self._query, page=str(page + 1))
+            url = 'http://{}{}?{}'.format(self.headers.get('Host'),
+                                          urllib.parse.urlsplit(self.path).path,
+                                          urllib.parse.urlencode(query))
+            headers['Link'] = '<{}>; rel="next"'.format(url)
+        self._send_json(200, items[start:start + per_page], headers)
+
+    def handle_user(self, login):
+        self._send_json(200, self.server.fixtures.get_user(login))
+
+    def handle_repo_list(self, login):
+        self._send_page(self.server.fixtures.get_repo_list(login))
+
+    def handle_repo(self, login, name):
+        self._send_json(200, self.server.fixtures.get_repo(login, name))
+
+    def handle_branch_list(self, login, name):
+        self._send_page(self.server.fixtures.get_branch_list())
+
+    def handle_tag_list(self, login, name):
+        self._send_page(self.server.fixtures.get_tag_list())
+
+    def handle_pull_request_list(self, login, name):
+        fixtures = self.server.fixtures
+        prs = fixtures.get_pull_request_list(self._query.get('state', 'open'))
+        if self._query.get('sort') == 'updated':
+            prs.sort(key=lambda pr: pr['updated_at'],
+                     reverse=self._query.get('direction', 'desc') == 'desc')
+        self._send_page(prs)
+
+    def handle_pull_request(self, login, name, id):
+        pr = self.server.fixtures.get_pull_request(int(id), detail=True)
+        if pr is None:
+            self._send_json(404, {'message': 'Not Found'})
+        else:
+            self._send_json(200, pr)
+
+    def handle_comments(self, login, name, id):
+        comments = self.server.fixtures.get_comments(int(id))
+        since = self._query.get('since')
+        if since is not None:
+            comments = [c for c in comments if c['updated_at'] >= since]
+        self._send_page(comments)
+
+    def handle_repo_comments(self, login, name):
+        fixtures = self.server.fixtures
+        comments = []
+        for id in range(1, fixtures.num_prs + 1):
+            comments.extend(fixtures.get_comments(id))
+        since = self._query.get('since')
+        if since is not None:
+            comments = [c for c in comments if c['updated_at'] >= since]
+        comments.sort(key=lambda c: (c['updated_at'], c['id']))
+        self._send_page(comments)
+
+    def handle_merge(self, login, name, id):
+        fixtures = self.server.fixtures
+        pr = fixtures.get_pull_request(int(id))
+        # merging works out mergeability on the spot
+        if pr is None or pr['state'] != 'open' or int(id) % 3 == 0:
+            self._send_json(405, {'message': 'Pull Request is not mergeable'})
+            return
+        fixtures.merged.add(int(id))
+        # the base branch has moved so the others need working out again
+        fixtures.mergeable_requested.clear()
+        self._send_json(200, {'sha': fixtures.get_sha('merge-' + id),
+                              'merged': True,
+                              'message': 'Pull Request successfully merged'})
+
+    def handle_tarball(self, login, name, ref):
+        # like GitHub, redirect to a different host serving the archive
+        url = 'http://localhost:{}/codeload/{}/{}/legacy.tar.gz/{}'.format(
+                self.server.server_address[1], login, name, ref)
+        self.send_response(302)
+        self.send_header('Location', url)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def handle_codeload(self, login, name, ref):
+        if 'Authorization' in self.headers:
+            self.server.fixtures.tarball_auth += 1
+        body = self.server.fixtures.get_tarball(ref)
+        m = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        start = int(m.group(1)) if m else 0
+        if start >= len(body) and m:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{}'.format(len(body)))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(206 if m else 200)
+        if m:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                    start, len(body) - 1, len(body)))
+        self.send_header('Content-Type', 'application/x-gzip')
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        self._send_body(body[start:])
+
+    def handle_fork(self, login, name):
+        self._send_json(202, self.server.fixtures.get_repo(USERNAME, name))
+
+    def handle_create_pull_request(self, login, name):
+        fixtures = self.server.fixtures
+        pr = fixtures.get_pull_request(1, detail=True)
+        pr['number'] = fixtures.num_prs + 1
+        pr['title'] = self._body['title']
+        pr['body'] = self._body['body']
+        self._send_json(201, pr)
+
+    def handle_graphql(self):
+        # only the pull request listing query used by gizz is supported
+        fixtures = self.server.fixtures
+        variables = self._body['variables']
+        states = [s.lower() for s in variables['states']]
+        state = 'open' if states == ['open'] else 'closed'
+        prs = fixtures.get_pull_request_list(state)
+        start = int(variables['after'] or 0)
+        end = start + variables['first']
+        nodes = []
+        for pr in prs[start:end]:
+            if pr['number'] in fixtures.merged:
+                state = 'MERGED'
+            else:
+                state = pr['state'].upper()
+            node = {'number': pr['number'],
+                    'state': state,
+                    'title': pr['title'],
+                    'body': pr['body'],
+                    'createdAt': pr['created_at'],
+                    'updatedAt': pr['updated_at'],
+                    'author': {'login': pr['user']['login']},
+                    'mergeable': 'MERGEABLE' if pr['number'] % 3
+                                 else 'CONFLICTING',
+                    'headRefName': pr['head']['ref'],
+                    'headRefOid': pr['head']['sha'],
+                    'headRepositoryOwner': {'login': pr['head']['user']['login']},
+                    'headRepository': {
+                        'name': pr['head']['repo']['name'],
+                        # what can be fetched from, as for git_url
+                        'url': pr['head']['repo']['git_url']},
+                    'baseRefName': pr['base']['ref'],
+                    'baseRefOid': pr['base']['sha']}
+            if variables.get('comments'):
+                comments = fixtures.get_comments(pr['number'])
+                node['comments'] = {
+                    'pageInfo': {'hasNextPage': False},
+                    'nodes': [{'author': c['user'], 'body': c['body']}
+                              for c in comments]}
+            nodes.append(node)
+        page_info = {'hasNextPage': end < len(prs), 'endCursor': str(end)}
+        self._send_json(200, {'data': {'repository': {'pullRequests': {
+                            'pageInfo': page_info, 'nodes': nodes}}}})
+
+
+class MockGitHubServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, fixtures, latency=0.0, address=('127.0.0.1', 0),
+                 error_rate=0.0, slow_rate=0.0, slow_latency=2.0,
+                 drop_rate=0.0):
+        http.server.ThreadingHTTPServer.__init__(self, address, Handler)
+        self.fixtures = fixtures
+        self.latency = latency
+        # the fraction of requests answered with a 502, of those that are
+        # cut off part way through and of those that take slow_latency
+        # longer than the others
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self._random = random.Random(0)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.reset_stats()
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count_request(self, nbytes):
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['bytes_in'] += nbytes
+            self._total_requests += 1
+
+    def handle_error(self, request, client_address):
+        # gizz closes connections it no longer needs the response from
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            http.server.ThreadingHTTPServer.handle_error(self, request,
+                                                         client_address)
+
+    def pick_fault(self):
+        with self._lock:
+            x = self._random.random()
+        for fault, rate in (('error', self.error_rate),
+                            ('drop', self.drop_rate),
+                            ('slow', self.slow_rate)):
+            if x < rate:
+                return fault
+            x -= rate
+        return None
+
+    def count_response(self, nbytes):
+        with self._lock:
+            self.stats['bytes_out'] += nbytes
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {'requests': 0, 'bytes_in': 0, 'bytes_out': 0}
+            self._total_requests = 0
+
+    def get_rate_limit(self):
+        with self._lock:
+            remaining = max(5000 - self._total_requests, 0)
+        return 5000, remaining, int(time.time()) + 3600
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='serve a stand-in for the GitHub API')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--prs', type=int, default=500)
+    parser.add_argument('--forks', type=int, default=50)
+    parser.add_argument('--tags', type=int, default=1000)
+    parser.add_argument('--branches', type=int, default=200)
+    parser.add_argument('--repos', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds to wait before each response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with a 502')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='fraction of responses cut off part way')
+    parser.add_argument('--slow-rate', type=float, default=0.0,
+                        help='fraction of requests answered slowly')
+    parser.add_argument('--slow-latency', type=float, default=2.0,
+                        help='extra seconds a slow response takes')
+    parser.add_argument('--git', action='store_true',
+                        help='also create git repositories to fetch from')
+    args = parser.parse_args()
+
+    git_dir = tempfile.mkdtemp(prefix='gizz-mock-') if args.git else None
+    fixtures = Fixtures(args.prs, args.forks, args.tags, args.branches,
+                        args.repos, git_dir=git_dir)
+    server = MockGitHubServer(fixtures, args.latency,
+                              ('127.0.0.1', args.port), args.error_rate,
+                              args.slow_rate, args.slow_latency,
+                              args.drop_rate)
+    print('Serving on {}, use GIZZ_API_URL={}'.format(server.url, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+# Copyright 2012 Ross Lagerwall
+# This file is part of gizz.
+
+# gizz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# gizz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with gizz.  If not, see <http://www.gnu.org/licenses/>.
+
+# Runs gizz subcommands against the stand-in GitHub server and a fixture git
+# repository, reporting the wall time, API requests, bytes transferred and
+# git subprocesses used by each one.
+#
+#   $ python3 bench/run.py --prs 2000 --forks 200 --latency 0.05
+
+import argparse
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+from mockgithub import Fixtures, MockGitHubServer, OWNER, REPO, USERNAME
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_ARG = '{}/{}'.format(OWNER, REPO)
+
+# name, gizz arguments
+COMMANDS = [
+    ('list-repos', ['list-repos', OWNER]),
+    ('list-branches', ['list-branches', '--repo', REPO_ARG]),
+    ('list-tags', ['list-tags', '--repo', REPO_ARG]),
+    ('list-tags --org', ['list-tags', '--org', OWNER]),
+    ('list-pr', ['list-pr', '--repo', REPO_ARG]),
+    ('list-pr -v', ['list-pr', '-v', '--repo', REPO_ARG]),
+    ('list-pr -v -c', ['list-pr', '-v', '-c', '--repo', REPO_ARG]),
+    ('list-pr <id>', ['list-pr', '-c', '--repo', REPO_ARG, '1']),
+    ('fetch-pr <id>', ['fetch-pr', '--repo', REPO_ARG, '1']),
+    ('fetch-pr', ['fetch-pr', '--repo', REPO_ARG]),
+    ('fetch-pr --add-remotes', ['fetch-pr', '--add-remotes',
+                                '--repo', REPO_ARG]),
+    ('fetch-pr --merge <id>', ['fetch-pr', '--merge', '--repo', REPO_ARG,
+                               '2']),
+    ('fetch-pr --merge <ids>', ['fetch-pr', '--merge', '--repo', REPO_ARG,
+                                '2', '4', '7', '8']),
+    ('download-tag', ['download-tag', '--repo', REPO_ARG, '-o', 'archives',
+                      'v0.1', 'v0.2', 'v0.3', 'v0.4', 'v0.5', 'v0.6', 'v0.7',
+                      'v0.8']),
+    ('fork', ['fork', '--repo', REPO_ARG]),
+    ('request-pull', ['request-pull', '--no-push']),
+]
+
+GIT_SHIM = '''#!/bin/sh
+echo "$*" >> "$GIZZ_BENCH_GIT_LOG"
+exec {git} "$@"
+'''
+
+EDITOR = '''#!/bin/sh
+printf 'Benchmark pull request\\n\\nBody of the pull request.\\n' > "$1.new"
+cat "$1" >> "$1.new"
+mv "$1.new" "$1"
+'''
+
+
+class Bench:
+
+    def __init__(self, args):
+        self._args = args
+        self._dir = tempfile.mkdtemp(prefix='gizz-bench-')
+        self._fixtures = Fixtures(args.prs, args.forks, args.tags,
+                                  args.branches, args.repos, args.comments,
+                                  git_dir=os.path.join(self._dir, 'git'),
+                                  mergeable_delay=args.mergeable_delay)
+        self._server = MockGitHubServer(self._fixtures, args.latency,
+                                        error_rate=args.error_rate,
+                                        slow_rate=args.slow_rate,
+                                        slow_latency=args.slow_latency,
+                                        drop_rate=args.drop_rate)
+        self._make_environment()
+        self._make_work_repo()
+
+    def _write_script(self, name, content):
+        path = os.path.join(self._dir, 'bin', name)
+        with open(path, 'w') as f:
+            f.write(content)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        return path
+
+    def _make_environment(self):
+        os.makedirs(os.path.join(self._dir, 'bin'))
+        # a git wrapper that logs each invocation so they can be counted
+        self._write_script('git', GIT_SHIM.format(git=shutil.which('git')))
+        editor = self._write_script('editor', EDITOR)
+        self._git_log = os.path.join(self._dir, 'git.log')
+
+        gitconfig = os.path.join(self._dir, 'gitconfig')
+        with open(gitconfig, 'w') as f:
+            f.write('[user]\n\tname = Bench\n\temail = bench@example.com\n'
+                    '[gizz]\n\tusername = {}\n\tauthtoken = token\n'.format(
+                        USERNAME))
+
+        self._env = dict(os.environ)
+        self._env.update({
+            'PATH': os.path.join(self._dir, 'bin') + os.pathsep +
+                    os.environ['PATH'],
+            'PYTHONPATH': ROOT,
+            'HOME': self._dir,
+            'XDG_CONFIG_HOME': os.path.join(self._dir, 'config'),
+            'GIT_CONFIG_GLOBAL': gitconfig,
+            'GIT_CONFIG_NOSYSTEM': '1',
+            'EDITOR': editor,
+            'GIZZ_API_URL': self._server.url,
+            'GIZZ_BENCH_GIT_LOG': self._git_log})
+        for name in self._args.config:
+            key, _, value = name.partition('=')
+            subprocess.check_call(['git', 'config', '--file', gitconfig,
+                                   key, value])
+
+    def _make_work_repo(self):
+        self._work_template = os.path.join(self._dir, 'work-template')
+        subprocess.check_call(['git', 'clone', '-q',
+                               self._fixtures.upstream_path,
+                               self._work_template], env=self._env)
+        subprocess.check_call(['git', 'remote', 'set-url', 'origin',
+                               'git@github.com:{}.git'.format(REPO_ARG)],
+                              cwd=self._work_template, env=self._env)
+
+    def run_command(self, argv):
+        # every command gets a fresh work tree and an empty cache
+        work = os.path.join(self._dir, 'work')
+        shutil.rmtree(work, ignore_errors=True)
+        shutil.copytree(self._work_template, work, symlinks=True)
+        shutil.rmtree(os.path.join(self._dir, 'config'), ignore_errors=True)
+        if self._args.warm:
+            self._run_gizz(argv, work)
+            self._fixtures.merged.clear()
+            self._fixtures.mergeable_requested.clear()
+
+        if os.path.exists(self._git_log):
+            os.unlink(self._git_log)
+        self._server.reset_stats()
+        start = time.perf_counter()
+        status = self._run_gizz(argv, work)
+        elapsed = time.perf_counter() - start
+        self._fixtures.merged.clear()
+        self._fixtures.mergeable_requested.clear()
+
+        git_calls = 0
+        if os.path.exists(self._git_log):
+            with open(self._git_log) as f:
+                git_calls = len(f.readlines())
+        result = {'wall': elapsed, 'status': status, 'git': git_calls}
+        result.update(self._server.stats)
+        return result
+
+    def _run_gizz(self, argv, cwd):
+        cmdline = [sys.executable, os.path.join(ROOT, 'bin', 'gizz')] + argv
+        p = subprocess.run(cmdline, cwd=cwd, env=self._env,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if p.stderr and self._args.verbose:
+            sys.stderr.write(p.stderr.decode(errors='replace'))
+        return p.returncode
+
+    def run(self):
+        self._server.start()
+        try:
+            results = []
+            for name, argv in COMMANDS:
+                if self._args.only and name.split()[0] not in self._args.only:
+                    continue
+                result = self.run_command(argv)
+                result['command'] = name
+                results.append(result)
+                if not self._args.json:
+                    self._print_result(result)
+        finally:
+            self._server.stop()
+            shutil.rmtree(self._dir, ignore_errors=True)
+        if self._args.json:
+            json.dump(results, sys.stdout, indent=2)
+            print()
+
+    def _print_result(self, result):
+        if not hasattr(self, '_printed_header'):
+            print('{:<24} {:>8} {:>8} {:>12} {:>10} {:>5}'.format(
+                    'command', 'wall(s)', 'requests', 'bytes out',
+                    'bytes in', 'git'))
+            self._printed_header = True
+        print('{:<24} {:>8.3f} {:>8} {:>12} {:>10} {:>5}'.format(
+                result['command'], result['wall'], result['requests'],
+                result['bytes_out'], result['bytes_in'], result['git']))
+        sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark gizz commands')
+    parser.add_argument('--prs', type=int, default=500)
+    parser.add_argument('--forks', type=int, default=50)
+    parser.add_argument('--tags', type=int, default=1000)
+    parser.add_argument('--branches', type=int, default=200)
+    parser.add_argument('--repos', type=int, default=100)
+    parser.add_argument('--comments', type=int, default=5,
+                        help='maximum number of comments per pull request')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds the server waits before each response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with a 502')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='fraction of responses cut off part way')
+    parser.add_argument('--slow-rate', type=float, default=0.0,
+                        help='fraction of requests answered slowly')
+    parser.add_argument('--slow-latency', type=float, default=2.0,
+                        help='extra seconds a slow response takes')
+    parser.add_argument('--mergeable-delay', type=float, default=0.0,
+                        help='seconds before the server knows whether a '
+                        'pull request is mergeable')
+    parser.add_argument('--warm', action='store_true',
+                        help='run each command once before measuring it')
+    parser.add_argument('-c', '--config', action='append', default=[],
+                        metavar='KEY=VALUE', help='set a gizz git config '
+                        'option, e.g. gizz.backend=graphql')
+    parser.add_argument('--only', action='append',
+                        help='only run the given subcommand')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="show gizz's error output")
+    Bench(parser.parse_args()).run()
+
+if __name__ == '__main__':
+    main()
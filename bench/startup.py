@@ -0,0 +1,105 @@
+# Copyright 2012 Ross Lagerwall
+# This file is part of gizz.
+
+# gizz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# gizz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with gizz.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measures how long gizz takes to start up for the paths that must stay fast
+# (--help and shell completion) and checks that they don't import any of the
+# networking modules. Exits with a non-zero status if the budget is exceeded.
+#
+#   $ python3 bench/startup.py --budget 0.05
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PATHS = [
+    ['--help'],
+    ['list-pr', '--help'],
+    ['--complete'],
+    ['--complete', 'list-pr'],
+]
+
+# modules that only the subcommands talking to GitHub should need
+FORBIDDEN = ('http', 'json', 'ssl', 'socket', 'urllib', 'email',
+             'concurrent', 'gizz.ghlib', 'gizz.builtins', 'gizz.utils')
+
+CHECK_IMPORTS = '''
+import sys
+sys.argv = ['gizz'] + sys.argv[1:]
+import gizz.main
+try:
+    gizz.main.run()
+except SystemExit:
+    pass
+sys.stdout = sys.__stdout__
+print('imports:', *(m for m in sys.modules
+                     if m in {forbidden} or m.split('.')[0] in {forbidden}))
+'''
+
+def time_command(cmdline, env, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmdline, env=env, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def get_forbidden_imports(argv, env):
+    code = CHECK_IMPORTS.format(forbidden=repr(set(FORBIDDEN)))
+    output = subprocess.check_output([sys.executable, '-c', code] + argv,
+                                     env=env, stderr=subprocess.DEVNULL)
+    for line in output.decode().splitlines():
+        if line.startswith('imports:'):
+            return line.split()[1:]
+    return []
+
+def main():
+    parser = argparse.ArgumentParser(description='measure gizz startup time')
+    parser.add_argument('--budget', type=float, default=0.05,
+                        help='allowed seconds on top of starting the '
+                        'interpreter (default: 0.05)')
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    baseline = time_command([sys.executable, '-c', 'pass'], env, args.runs)
+    print('{:<28} {:>8.1f} ms'.format('python -c pass', baseline * 1000))
+
+    failed = False
+    for argv in PATHS:
+        cmdline = [sys.executable, os.path.join(ROOT, 'bin', 'gizz')] + argv
+        elapsed = time_command(cmdline, env, args.runs)
+        overhead = elapsed - baseline
+        imports = get_forbidden_imports(argv, env)
+        status = 'ok'
+        if overhead > args.budget:
+            status = 'over budget'
+            failed = True
+        if imports:
+            status = 'imports ' + ', '.join(imports)
+            failed = True
+        print('{:<28} {:>8.1f} ms  +{:.1f} ms  {}'.format(
+                'gizz ' + ' '.join(argv), elapsed * 1000, overhead * 1000,
+                status))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
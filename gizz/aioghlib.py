@@ -0,0 +1,486 @@
+# Copyright 2012 Ross Lagerwall
+# This file is part of gizz.
+
+# gizz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# gizz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with gizz.  If not, see <http://www.gnu.org/licenses/>.
+
+# An asyncio version of the ghlib models for use from event loops, e.g.
+#
+#   async with Client(token) as client:
+#       repo = client.get_repository('owner', 'project')
+#       async for pr in repo.get_pull_request_list():
+#           print(pr.id, pr.title)
+#
+# Unlike ghlib, nothing is global: each Client has its own token, connection
+# pool, rate limiter and identity map. Attributes aren't loaded on access;
+# await load() (or a get_*() method) for the ones a list doesn't include.
+
+import asyncio
+import http.client
+import io
+import json
+import urllib.parse
+import zlib
+import gizz.ghlib
+from gizz.utils import ApiException, RateLimitException
+from gizz.ratelimit import RateLimiter
+from gizz.trace import trace_span
+
+_MAX_RETRIES = 5
+
+async def gather_limited(aws, limit, return_exceptions=False):
+    # like asyncio.gather() but with at most limit of aws running at a time
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*[run(aw) for aw in aws],
+                                return_exceptions=return_exceptions)
+
+
+class _Connection:
+
+    def __init__(self, reader, writer, read_timeout):
+        self.reader = reader
+        self.writer = writer
+        self.read_timeout = read_timeout
+
+    def close(self):
+        self.writer.close()
+
+    async def request(self, method, location, headers, body):
+        lines = ['{} {} HTTP/1.1'.format(method, location)]
+        lines.extend('{}: {}'.format(k, v) for k, v in headers.items())
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') +
+                          body)
+        await self._wait(self.writer.drain())
+
+        while True:
+            head = await self._wait(self.reader.readuntil(b'\r\n\r\n'))
+            status_line, _, rest = head.partition(b'\r\n')
+            version, status = status_line.split(b' ', 2)[:2]
+            status = int(status)
+            if status >= 200:
+                break
+            # skip 100 Continue
+
+        resp_headers = http.client.parse_headers(io.BytesIO(rest))
+        will_close = (version == b'HTTP/1.0' or
+                      resp_headers.get('Connection', '').lower() == 'close')
+        if method == 'HEAD' or status in (204, 304):
+            data = b''
+        elif resp_headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            data = await self._read_chunked()
+        elif 'Content-Length' in resp_headers:
+            data = await self._wait(self.reader.readexactly(
+                    int(resp_headers['Content-Length'])))
+        else:
+            chunks = []
+            while True:
+                chunk = await self._wait(self.reader.read(65536))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            data = b''.join(chunks)
+            will_close = True
+        return status, resp_headers, data, will_close
+
+    def _wait(self, aw):
+        # each read has to make progress within the read timeout
+        return asyncio.wait_for(aw, self.read_timeout)
+
+    async def _read_chunked(self):
+        chunks = []
+        while True:
+            line = await self._wait(self.reader.readuntil(b'\r\n'))
+            size = int(line.split(b';')[0], 16)
+            if size == 0:
+                break
+            chunks.append(await self._wait(self.reader.readexactly(size)))
+            await self._wait(self.reader.readexactly(2))
+        # skip any trailers
+        while await self._wait(self.reader.readuntil(b'\r\n')) != b'\r\n':
+            pass
+        return b''.join(chunks)
+
+
+class Client:
+
+    # The timeouts are in seconds, or None for no limit, with the same
+    # defaults as gizz.connecttimeout and gizz.readtimeout.
+    def __init__(self, auth_token, url=None, max_connections=10,
+                 limiter=None, connect_timeout=10.0, read_timeout=60.0):
+        if url is None:
+            url = '{}://{}'.format(gizz.ghlib.SCHEME, gizz.ghlib.HOSTNAME)
+        parts = urllib.parse.urlsplit(url)
+        self._ssl = parts.scheme == 'https'
+        self._host = parts.hostname
+        self._port = parts.port or (443 if self._ssl else 80)
+        self._netloc = parts.netloc
+        self._auth_token = auth_token
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._connections = asyncio.Semaphore(max_connections)
+        self._idle = []
+        self._limiter = limiter if limiter is not None else RateLimiter()
+        self._objects = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _get_object(self, cls, *args):
+        # the one object representing the resource at the API path, as in
+        # ghlib's identity map
+        path = cls._get_path(*args)
+        obj = self._objects.get(path)
+        if obj is None:
+            obj = cls(self, *args)
+            self._objects[path] = obj
+        return obj
+
+    def get_user(self, username):
+        return self._get_object(User, username)
+
+    def get_organization(self, org):
+        return self._get_object(Organization, org)
+
+    def get_repository(self, owner, reponame):
+        return self._get_object(Repository, self.get_user(owner), reponame)
+
+    async def _send(self, method, location, headers, body):
+        # As in ghlib, only a GET may go on an idle connection. Anything else
+        # gets a new one: a request that fails on an idle connection may have
+        # reached the server and could only be retried by sending it again.
+        idempotent = method in ('GET', 'HEAD')
+        async with self._connections:
+            while True:
+                if self._idle and idempotent:
+                    conn, reused = self._idle.pop(), True
+                else:
+                    reader, writer = await asyncio.wait_for(
+                            asyncio.open_connection(self._host, self._port,
+                                                    ssl=self._ssl or None),
+                            self._connect_timeout)
+                    conn = _Connection(reader, writer, self._read_timeout)
+                    reused = False
+                try:
+                    with trace_span('{} {}'.format(method, location), 'api',
+                                    reused=reused,
+                                    bytes_sent=len(body)) as span:
+                        status, resp_headers, data, will_close = \
+                                await conn.request(method, location, headers,
+                                                   body)
+                        span['status'] = status
+                        span['bytes_received'] = len(data)
+                except (OSError, EOFError, asyncio.IncompleteReadError,
+                        ValueError, asyncio.TimeoutError) as e:
+                    conn.close()
+                    if reused and not isinstance(e, asyncio.TimeoutError):
+                        # the server closed an idle connection, try another
+                        continue
+                    raise
+                break
+            if will_close:
+                conn.close()
+            else:
+                self._idle.append(conn)
+        return status, resp_headers, data
+
+    async def request(self, method, location, post_object=None):
+        # returns the status, headers and decoded body of a response
+        body = b'' if post_object is None else json.dumps(post_object).encode()
+        headers = {'Host': self._netloc,
+                   'Authorization': 'token ' + self._auth_token,
+                   'User-agent': 'gizz',
+                   'Accept-Encoding': 'gzip'}
+        if post_object is not None or method in ('POST', 'PUT', 'PATCH'):
+            headers['Content-Length'] = str(len(body))
+
+        attempt = 0
+        while True:
+            delay = self._limiter.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            status, resp_headers, data = await self._send(method, location,
+                                                          headers, body)
+            self._limiter.update(resp_headers)
+            if resp_headers.get('Content-Encoding') == 'gzip':
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            delay = self._limiter.get_retry_delay(status, resp_headers, data,
+                                                  attempt)
+            if delay is None:
+                break
+            if attempt == _MAX_RETRIES:
+                raise RateLimitException()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+        data = json.loads(data) if data else None
+        if status >= 400:
+            if isinstance(data, dict) and 'message' in data:
+                raise ApiException(data['message'])
+            raise ApiException('{} {} failed with status {}'.format(
+                    method, location, status))
+        return status, resp_headers, data
+
+    async def get(self, location):
+        _, _, data = await self.request('GET', location)
+        return data
+
+    async def iter_pages(self, location):
+        # yields the items of a list response, following the Link headers
+        # to fetch the remaining pages
+        while location is not None:
+            _, headers, data = await self.request('GET', location)
+            if not isinstance(data, list):
+                raise ApiException('expected a list')
+            for item in data:
+                yield item
+            location = None
+            for url, rel in gizz.ghlib._link_re.findall(
+                    headers.get('Link', '')):
+                if rel == 'next':
+                    location = urllib.parse.urlsplit(url)._replace(
+                        scheme='', netloc='').geturl()
+
+
+def _quote(value):
+    return urllib.parse.quote(str(value), safe='')
+
+
+class _Model:
+
+    _load_future = None
+
+    async def load(self):
+        # loads the full resource, once however many tasks wait for it
+        if self._load_future is None:
+            self._load_future = asyncio.ensure_future(self._load())
+        await asyncio.shield(self._load_future)
+        return self
+
+
+class User(_Model):
+
+    _repo_list_location = '/users/{}/repos?per_page={}'
+
+    @staticmethod
+    def _get_path(username):
+        return '/users/{}'.format(username).lower()
+
+    def __init__(self, client, username):
+        self.client = client
+        self.username = username
+
+    def _load_from_data(self, data):
+        self.name = data['name']
+        self.following = data['following']
+
+    async def _load(self):
+        data = await self.client.get('/users/' + _quote(self.username))
+        self._load_from_data(data)
+
+    async def get_repo_list(self, per_page=100):
+        location = self._repo_list_location.format(_quote(self.username),
+                                                   per_page)
+        async for repo_data in self.client.iter_pages(location):
+            repo = self.client._get_object(Repository, self,
+                                           repo_data['name'])
+            repo._load_from_data(repo_data)
+            yield repo
+
+
+class Organization(User):
+
+    _repo_list_location = '/orgs/{}/repos?per_page={}'
+
+    @staticmethod
+    def _get_path(username):
+        return '/orgs/{}'.format(username).lower()
+
+    def _load_from_data(self, data):
+        self.name = data['name']
+        self.following = 0
+
+    async def _load(self):
+        data = await self.client.get('/orgs/' + _quote(self.username))
+        self._load_from_data(data)
+
+
+class Repository(_Model):
+
+    @staticmethod
+    def _get_path(user, reponame):
+        return '/repos/{}/{}'.format(user.username, reponame).lower()
+
+    def __init__(self, client, user, reponame):
+        self.client = client
+        self.user = user
+        self.reponame = reponame
+
+    def _get_location(self, suffix=''):
+        return '/repos/{}/{}{}'.format(_quote(self.user.username),
+                                       _quote(self.reponame), suffix)
+
+    def _load_from_data(self, data):
+        self.git_url = data['git_url']
+        self.ssh_url = data['ssh_url']
+        self.description = data['description']
+        if 'parent' in data:
+            self.parent = self.client.get_repository(
+                    data['parent']['owner']['login'], data['parent']['name'])
+            self.parent._load_from_data(data['parent'])
+
+    async def _load(self):
+        self._load_from_data(await self.client.get(self._get_location()))
+
+    async def get_branch_list(self, per_page=100):
+        location = self._get_location('/branches?per_page={}'.format(per_page))
+        async for branch_data in self.client.iter_pages(location):
+            branch = Branch(self, branch_data['name'])
+            branch.sha = branch_data['commit']['sha']
+            yield branch
+
+    async def get_tag_list(self, per_page=100):
+        location = self._get_location('/tags?per_page={}'.format(per_page))
+        async for tag_data in self.client.iter_pages(location):
+            yield Tag(self, tag_data['name'], tag_data['commit']['sha'],
+                      tag_data['tarball_url'])
+
+    async def get_pull_request_list(self, closed=False, per_page=100):
+        location = self._get_location('/pulls?state={}&per_page={}'.format(
+                'closed' if closed else 'open', per_page))
+        async for pull_req_data in self.client.iter_pages(location):
+            pr = self.get_pull_request(pull_req_data['number'])
+            pr._load_from_data(pull_req_data)
+            yield pr
+
+    def get_pull_request(self, id):
+        return self.client._get_object(PullRequest, self, id)
+
+    def __str__(self):
+        return "{user}/{repo}".format(user=self.user.username,
+                                      repo=self.reponame)
+
+
+class Branch:
+
+    def __init__(self, repo, name):
+        self.repo = repo
+        self.name = name
+
+    async def create_pull_request(self, title, body, source):
+        post_data = {'title': title,
+                     'body': body,
+                     'head': '{}:{}'.format(source.repo.user.username,
+                                            source.name),
+                     'base': self.name}
+        _, _, data = await self.repo.client.request(
+                'POST', self.repo._get_location('/pulls'), post_data)
+        pr = self.repo.get_pull_request(data['number'])
+        pr._load_from_data(data)
+        return pr
+
+
+class Tag:
+
+    def __init__(self, repo, name, sha, tarball_url):
+        self.repo = repo
+        self.name = name
+        self.sha = sha
+        self.tarball_url = tarball_url
+
+
+class PullRequest(_Model):
+
+    @staticmethod
+    def _get_path(repo, id):
+        return '/repos/{}/{}/pulls/{}'.format(repo.user.username,
+                                              repo.reponame, id).lower()
+
+    def __init__(self, client, repo, id):
+        self.client = client
+        self.repo = repo
+        self.id = id
+
+    def _load_from_data(self, data):
+        self.title = data['title']
+        self.body = data['body']
+        self.create_date = data['created_at']
+        # not included in list responses
+        if 'mergeable' in data:
+            self.mergeable = data['mergeable']
+
+        head_data = data['head']
+        head_user = self.client.get_user(head_data['user']['login'])
+        if head_data['repo'] is None:
+            # the head repository has been deleted
+            head_repo = self.client._get_object(Repository, head_user, None)
+            git_url = None
+        else:
+            head_repo = self.client._get_object(Repository, head_user,
+                                                head_data['repo']['name'])
+            git_url = head_data['repo']['git_url']
+        self.head = Branch(head_repo, head_data['ref'])
+        self.head.sha = head_data['sha']
+        self.head.git_url = git_url
+        self.base = Branch(self.repo, data['base']['ref'])
+        self.base.sha = data['base']['sha']
+
+    async def _load(self):
+        self._load_from_data(await self.client.get(
+                self.repo._get_location('/pulls/{}'.format(self.id))))
+
+    async def get_mergeable(self):
+        if not hasattr(self, 'mergeable'):
+            await self.load()
+        return self.mergeable
+
+    async def get_comments(self, per_page=100):
+        location = self.repo._get_location(
+                '/issues/{}/comments?per_page={}'.format(self.id, per_page))
+        comments = []
+        async for c in self.client.iter_pages(location):
+            comments.append(PullRequestComment(
+                    self, self.client.get_user(c['user']['login']),
+                    c['body'].strip()))
+        return comments
+
+    async def automerge(self):
+        # returns the merge commit, or None with GitHub's reason if the pull
+        # request couldn't be merged
+        try:
+            _, _, data = await self.client.request(
+                    'PUT', self.repo._get_location('/pulls/{}/merge'.format(
+                            self.id)), {})
+        except ApiException as e:
+            return None, e.msg
+        return data['sha'], data['message']
+
+
+class PullRequestComment:
+
+    def __init__(self, pr, user, body):
+        self.pr = pr
+        self.user = user
+        self.body = body
@@ -16,7 +16,10 @@
 
 import os.path
 import re
+import sys
 import gizz.ghlib
+import gizz.index
+import gizz.output
 from gizz.utils import *
 
 class Cmd:
@@ -27,13 +30,11 @@ class Cmd:
         pass
 
     def _get_gh_name(self, remote_name):
-        output = git_system('remote', '-v', 'show')
-        for line in output.strip().split('\n'):
-            name, url, _ = line.split()
-            if name == remote_name:
-                matches = self.gh_url.findall(url)
-                if len(matches) > 0:
-                    return matches[0]
+        url = get_context().get_remote_url(remote_name)
+        if url is not None:
+            matches = self.gh_url.findall(url)
+            if len(matches) > 0:
+                return matches[0]
 
         return (None, None)
 
@@ -48,43 +49,166 @@ class Cmd:
                 pass
         return user, repo, remote_name
 
+    def _get_record_writer(self, fields):
+        # None for the usual text output
+        if self._format == 'text':
+            return None
+        return gizz.output.get_record_writer(self._format, fields)
+
+    def _set_repo_list_args(self, args):
+        self._arg_repos = args.repo or []
+        self._arg_users = args.user or []
+        self._arg_orgs = args.org or []
+        self._jobs = args.jobs
+        # name the repo in the output if there can be more than one
+        self._show_repo = (len(self._arg_repos) > 1 or
+                           bool(self._arg_users or self._arg_orgs))
+
+    def _get_repo_list(self):
+        # the repos given by --repo, --user and --org in that order, or the
+        # current one
+        if not (self._arg_repos or self._arg_users or self._arg_orgs):
+            user, repo, _ = self._get_best_gh_name()
+            return [gizz.ghlib.Repository(gizz.ghlib.User(user), repo)]
+
+        repos = []
+        for name in self._arg_repos:
+            user, repo = name.split('/')
+            repos.append(gizz.ghlib.Repository(gizz.ghlib.User(user), repo))
+        for username in self._arg_users:
+            repos.extend(gizz.ghlib.User(username).get_repo_list())
+        for org in self._arg_orgs:
+            repos.extend(gizz.ghlib.Organization(org).get_repo_list())
+        # the identity map gives a repo named twice the same object
+        return list(dict.fromkeys(repos))
+
+    def _list_repos(self, func, repos):
+        # Yields each repo with the items func returns for it, querying up to
+        # --jobs repos at a time. With several repos, one that can't be
+        # listed is reported and skipped instead of ending the command.
+        if len(repos) == 1:
+            yield repos[0], func(repos[0])
+            return
+
+        def list_repo(repo):
+            try:
+                return repo, list(func(repo))
+            except (ApiException, NetworkException, RateLimitException) as e:
+                print("Failed to list {}: {}".format(repo, e), file=sys.stderr)
+                return repo, []
+
+        yield from ordered_map(list_repo, repos, self._jobs)
+
 
 class Cmd_ListRepos(Cmd):
 
     def __init__(self, args):
         Cmd.__init__(self)
         self._username = args.user
+        self._format = args.format
 
     def run(self):
         if self._username is None:
             user = gizz.ghlib.User(get_auth().get_username())
         else:
             user = gizz.ghlib.User(self._username)
-        for repo in user.get_repo_list():
-            print(repo.reponame)
+        writer = self._get_record_writer(('repo', 'name', 'description',
+                                          'git_url'))
+        try:
+            for repo in user.get_repo_list():
+                if writer is None:
+                    print(repo.reponame)
+                else:
+                    writer.write({'repo': str(repo),
+                                  'name': repo.reponame,
+                                  'description': repo.description,
+                                  'git_url': repo.git_url})
+        finally:
+            if writer is not None:
+                writer.close()
 
 
 class Cmd_ListBranches(Cmd):
 
     def __init__(self, args):
         Cmd.__init__(self)
-        self._arg_repo = args.repo
+        self._set_repo_list_args(args)
+        self._format = args.format
 
     def run(self):
-        if self._arg_repo is None:
-            user, repo, _ = self._get_best_gh_name()
-        else:
-            user, repo = self._arg_repo.split('/')
-        repo = gizz.ghlib.Repository(gizz.ghlib.User(user), repo)
-        for branch in repo.get_branch_list():
-            print(branch.name)
+        writer = self._get_record_writer(('repo', 'name', 'sha'))
+        try:
+            branch_lists = self._list_repos(
+                lambda repo: repo.get_branch_list(), self._get_repo_list())
+            for repo, branches in branch_lists:
+                for branch in branches:
+                    if writer is not None:
+                        writer.write({'repo': str(repo),
+                                      'name': branch.name,
+                                      'sha': branch.sha})
+                    elif self._show_repo:
+                        print(repo, branch.name)
+                    else:
+                        print(branch.name)
+        finally:
+            if writer is not None:
+                writer.close()
 
 
 class Cmd_ListTags(Cmd):
 
+    def __init__(self, args):
+        Cmd.__init__(self)
+        self._set_repo_list_args(args)
+        self._format = args.format
+
+    def run(self):
+        writer = self._get_record_writer(('repo', 'name', 'sha',
+                                          'tarball_url'))
+        try:
+            tag_lists = self._list_repos(
+                lambda repo: repo.get_tag_list(), self._get_repo_list())
+            for repo, tags in tag_lists:
+                for tag in tags:
+                    if writer is not None:
+                        writer.write({'repo': str(repo),
+                                      'name': tag.name,
+                                      'sha': tag.sha,
+                                      'tarball_url': tag.tarball_url})
+                    elif self._show_repo:
+                        print(repo, tag.name, tag.sha[:10])
+                    else:
+                        print(tag.name, tag.sha[:10])
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+class Cmd_DownloadTag(Cmd):
+
     def __init__(self, args):
         Cmd.__init__(self)
         self._arg_repo = args.repo
+        self._tags = list(dict.fromkeys(args.tag))
+        self._output_dir = args.output_dir
+        self._arg_sha256 = args.sha256 or []
+        self._jobs = args.jobs
+
+    def _get_digests(self):
+        digests = {}
+        for arg in self._arg_sha256:
+            tag, _, digest = arg.rpartition('=')
+            if not tag:
+                if len(self._tags) > 1:
+                    raise InvalidArgumentException(
+                        '--sha256 needs TAG= with more than one tag')
+                tag = self._tags[0]
+            elif tag not in self._tags:
+                raise InvalidArgumentException(
+                    '--sha256 given for {}, which is not being '
+                    'downloaded'.format(tag))
+            digests[tag] = digest
+        return digests
 
     def run(self):
         if self._arg_repo is None:
@@ -92,8 +216,25 @@ class Cmd_ListTags(Cmd):
         else:
             user, repo = self._arg_repo.split('/')
         repo = gizz.ghlib.Repository(gizz.ghlib.User(user), repo)
-        for tag in repo.get_tag_list():
-            print(tag.name, tag.sha[:10])
+        digests = self._get_digests()
+        os.makedirs(self._output_dir, exist_ok=True)
+
+        def download(tag):
+            path = os.path.join(self._output_dir, '{}-{}.tar.gz'.format(
+                    repo.reponame, tag.replace('/', '-')))
+            try:
+                return path, repo.download_tarball('refs/tags/' + tag, path,
+                                                   digests.get(tag))
+            except (DownloadException, NetworkException) as e:
+                print(e, file=sys.stderr)
+                return path, None
+
+        # in the format of sha256sum, so the output can be checked with
+        # sha256sum -c later
+        for path, digest in ordered_map(download, self._tags, self._jobs):
+            if digest is not None:
+                print('{}  {}'.format(digest, path))
+                sys.stdout.flush()
 
 
 class Cmd_Fork(Cmd):
@@ -124,48 +265,177 @@ class Cmd_ListPullRequests(Cmd):
 
     def __init__(self, args):
         Cmd.__init__(self)
-        self._arg_repo = args.repo
+        self._set_repo_list_args(args)
         self._verbose = args.verbose
         self._id = args.id
         self._comments = args.comments
+        self._no_cache = args.no_cache
+        self._comment_index = None
+        self._format = args.format
+        self._writer = None
         self._closed = args.closed
-
-    def _print(self, pr, verbose=True):
+        self._offline = args.offline
+        self._author = args.author
+        self._branch = args.branch
+
+    def _fetch_details(self, pr):
+        # do the requests needed to print a pull request so that they can be
+        # run from a worker thread
+        if self._verbose:
+            pr.mergeable
+        comments = self._get_comments(pr) if self._comments else None
+        return pr, comments
+
+    def _get_pr_name(self, pr):
+        if self._show_repo:
+            return '{}#{}'.format(pr.repo, pr.id)
+        return pr.id
+
+    def _get_comments(self, pr):
+        # comments seen before are kept in the index so that only new ones
+        # are fetched
+        if self._comment_index is None:
+            return pr.get_comments()
+        return self._comment_index.get_comments(pr)
+
+    def _get_mergeable_note(self, mergeable):
+        if mergeable is None:
+            # GitHub hasn't worked it out yet
+            return " [mergeability unknown]"
+        return " [auto-mergeable]" if mergeable else ""
+
+    def _get_fields(self, verbose):
+        fields = ['repo', 'id', 'title', 'author', 'head', 'base',
+                  'created_at', 'updated_at']
+        if verbose:
+            fields += ['head_sha', 'base_sha', 'git_url', 'mergeable', 'body']
+        if self._comments:
+            fields.append('comments')
+        return fields
+
+    def _write_record(self, pr, verbose, comments):
+        record = {'repo': str(pr.repo),
+                  'id': pr.id,
+                  'title': pr.title,
+                  'author': pr.author,
+                  'head': pr.head.name,
+                  'base': pr.base.name,
+                  'created_at': pr.create_date,
+                  'updated_at': pr.update_date}
+        if verbose:
+            record.update({'head_sha': pr.head.sha,
+                           'base_sha': pr.base.sha,
+                           'git_url': pr.head.git_url,
+                           'mergeable': pr.mergeable,
+                           'body': pr.body})
+        if self._comments:
+            if comments is None:
+                comments = self._get_comments(pr)
+            record['comments'] = [{'author': c.user.username, 'body': c.body}
+                                  for c in comments]
+        self._writer.write(record)
+
+    def _print(self, pr, verbose=True, comments=None):
+        if self._writer is not None:
+            self._write_record(pr, verbose, comments)
+            return
         if verbose:
             print("From:", pr.head.repo.user.username)
             print("Remote URL:", pr.head.git_url)
             print("Date:", pr.create_date)
-            print("Id:", pr.id)
+            print("Id:", self._get_pr_name(pr))
             print("Subject:", pr.title)
             print("Merge {} at {}\n   to {} at {}{}".format(
                     pr.head.name, pr.head.sha, pr.base.name, pr.base.sha,
-                    " [auto-mergeable]" if pr.mergeable else ""))
+                    self._get_mergeable_note(pr.mergeable)))
             print(pr.body.strip())
         else:
-            print(pr.id, '=>', pr.title)
+            print(self._get_pr_name(pr), '=>', pr.title)
         if self._comments:
-            comments = pr.get_comments()
+            if comments is None:
+                comments = self._get_comments(pr)
             if comments:
                 print()
             for c in comments:
                 print("Comment from:", c.user.username)
                 print(c.body)
 
+    def _matches(self, pr):
+        if (self._author is not None and
+            pr.author.lower() != self._author.lower()):
+            return False
+        return self._branch is None or pr.base.name == self._branch
+
+    def _get_offline_list(self, index, repo):
+        if not index.is_synced(repo):
+            raise NotSyncedException(repo)
+        pr_list = index.get_pull_request_list(
+            repo, closed=self._closed, number=self._id, author=self._author,
+            branch=self._branch, comments=self._comments)
+        if self._id and not pr_list:
+            raise InvalidArgumentException(
+                'pull request #{} is not in the index'.format(self._id))
+        return pr_list
+
+    def _get_pull_request_list(self, repo):
+        pr_list = repo.get_pull_request_list(closed=self._closed,
+                                             comments=self._comments)
+        if self._author is not None or self._branch is not None:
+            pr_list = filter(self._matches, pr_list)
+        return pr_list
+
+    def _print_list(self, details, verbose):
+        for i, (pr, comments) in enumerate(details):
+            if self._verbose and i != 0 and self._writer is None:
+                print('--')
+            self._print(pr, verbose, comments)
+
+    def run(self):
+        repos = self._get_repo_list()
+        if self._id and len(repos) > 1:
+            raise InvalidArgumentException(
+                'an id can only be given with a single repository')
+        if self._comments and not self._offline and not self._no_cache:
+            self._comment_index = gizz.index.PullRequestIndex(
+                    get_index_path())
+        self._writer = self._get_record_writer(
+                self._get_fields(self._verbose or self._id is not None))
+        try:
+            if self._offline:
+                index = gizz.index.PullRequestIndex(get_index_path())
+                details = ((pr, None) for repo in repos
+                           for pr in self._get_offline_list(index, repo))
+                self._print_list(details,
+                                 self._verbose or self._id is not None)
+            elif self._id:
+                pr = repos[0].get_pull_request(self._id)
+                self._print(pr)
+            else:
+                pr_lists = self._list_repos(self._get_pull_request_list, repos)
+                pr_list = (pr for _, prs in pr_lists for pr in prs)
+                details = ordered_map(self._fetch_details, pr_list, self._jobs)
+                self._print_list(details, self._verbose)
+        finally:
+            if self._writer is not None:
+                self._writer.close()
+
+
+class Cmd_Sync(Cmd):
+
+    def __init__(self, args):
+        Cmd.__init__(self)
+        self._arg_repo = args.repo
+
     def run(self):
         if self._arg_repo is None:
             user, repo, _ = self._get_best_gh_name()
         else:
             user, repo = self._arg_repo.split('/')
         repo = gizz.ghlib.Repository(gizz.ghlib.User(user), repo)
-        if self._id:
-            pr = repo.get_pull_request(self._id)
-            self._print(pr)
-        else:
-            pr_list = repo.get_pull_request_list(closed=self._closed)
-            for i, pr in enumerate(pr_list):
-                if self._verbose and i != 0:
-                    print('--')
-                self._print(pr, self._verbose)
+        index = gizz.index.PullRequestIndex(get_index_path())
+        num_prs, num_comments = index.sync(repo)
+        print("Synced {}: {} pull request(s) and {} comment(s) updated".format(
+                repo, num_prs, num_comments))
 
 
 class Cmd_FetchPullRequest(Cmd):
@@ -173,30 +443,63 @@ class Cmd_FetchPullRequest(Cmd):
     def __init__(self, args):
         Cmd.__init__(self)
         self._arg_repo = args.repo
-        self._id = args.id
-        self._fetch_all = args.id is None
+        self._ids = args.id
+        self._fetch_all = not args.id
         self._automerge = args.merge
+        self._add_remotes = args.add_remotes
+        self._jobs = args.jobs
+        self._timeout = args.timeout
 
     def run(self):
+        remote_name = None
         if self._arg_repo is None:
-            user, repo, _ = self._get_best_gh_name()
+            user, repo, remote_name = self._get_best_gh_name()
         else:
             user, repo = self._arg_repo.split('/')
         repo = gizz.ghlib.Repository(gizz.ghlib.User(user), repo)
         if self._fetch_all:
             if self._automerge:
                 raise InvalidArgumentException('--merge requires a specific id')
-            for pr in repo.get_pull_request_list():
-                self._fetch_one_pull_request(pr)
+            if self._add_remotes:
+                self._fetch_all_from_remotes(repo)
+            else:
+                self._fetch_all_pull_requests(repo, remote_name)
         else:
-            pr = repo.get_pull_request(self._id)
+            pr_list = [repo.get_pull_request(id) for id in self._ids]
             if self._automerge:
-                sha, msg = pr.automerge()
-                print(msg)
-                if sha:
-                    print('{} is now at {}'.format(pr.base.name, sha))
+                self._merge_pull_requests(pr_list)
             else:
-                self._fetch_one_pull_request(pr)
+                for pr in pr_list:
+                    self._fetch_one_pull_request(pr)
+
+    def _merge_pull_requests(self, pr_list):
+        # merge in the order given, each as soon as GitHub knows it can be
+        # merged; the later ones are polled meanwhile
+        ready = {}
+        waiting = gizz.ghlib.wait_for_mergeable(pr_list, self._timeout,
+                                                self._jobs)
+        for pr in pr_list:
+            for ready_pr, mergeable in waiting:
+                ready[ready_pr] = mergeable
+                if ready_pr is pr:
+                    break
+            mergeable = ready.get(pr)
+            if pr.state != 'open':
+                print("#{}: already {}".format(
+                        pr.id, 'merged' if pr.merged else 'closed'),
+                      file=sys.stderr)
+                continue
+            if mergeable is None:
+                print("#{}: GitHub hasn't worked out whether it can be "
+                      "merged, try again later".format(pr.id), file=sys.stderr)
+                continue
+            if not mergeable:
+                print("#{}: not mergeable".format(pr.id), file=sys.stderr)
+                continue
+            sha, msg = pr.automerge()
+            print("#{}: {}".format(pr.id, msg))
+            if sha:
+                print('{} is now at {}'.format(pr.base.name, sha))
 
     def _fetch_one_pull_request(self, pr):
         fetched_branch = pr.fetch()
@@ -206,6 +509,35 @@ class Cmd_FetchPullRequest(Cmd):
                                                         pr.head.name))
         print("Merge {} into {}".format(fetched_branch, pr.base.name))
 
+    def _print_fetch_progress(self, remote, error):
+        if error is None:
+            print("Fetched {}".format(remote))
+        else:
+            print("Failed to fetch {}: {}".format(remote, error),
+                  file=sys.stderr)
+
+    def _fetch_all_from_remotes(self, repo):
+        branches, errors = gizz.ghlib.fetch_pull_requests_from_remotes(
+            repo.get_pull_request_list(), self._jobs,
+            self._print_fetch_progress)
+        for pr, fetched_branch in branches:
+            username = pr.head.repo.user.username
+            print("Created branch {} tracking {}/{}".format(fetched_branch,
+                                                            username,
+                                                            pr.head.name))
+            print("Merge {} into {}".format(fetched_branch, pr.base.name))
+        if errors:
+            print("Failed to fetch from {} remote(s): {}".format(
+                    len(errors), ', '.join(sorted(errors))), file=sys.stderr)
+
+    def _fetch_all_pull_requests(self, repo, remote_name):
+        pr_list = repo.get_pull_request_list()
+        for pr, fetched_branch in repo.fetch_pull_requests(pr_list,
+                                                           remote_name):
+            print("Created branch {} from pull request #{}".format(
+                    fetched_branch, pr.id))
+            print("Merge {} into {}".format(fetched_branch, pr.base.name))
+
 
 class Cmd_RequestPull(Cmd):
 
@@ -257,10 +589,10 @@ class Cmd_RequestPull(Cmd):
 
     def run(self):
         if self._head is None:
-            output = git_system('branch')
-            for line in output.split("\n"):
-                if line.startswith('*'):
-                    head = line[2:]
+            head = get_context().get_current_branch()
+            if head is None:
+                raise InvalidArgumentException(
+                    'not on a branch, use --head to choose one')
         else:
             head = self._head
 
@@ -0,0 +1,130 @@
+# Copyright 2012 Ross Lagerwall
+# This file is part of gizz.
+
+# gizz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# gizz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with gizz.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# once the cache is over its maximum size, entries are evicted until it's
+# down to this fraction of it, so that the next writes don't each have to
+# evict again
+_LOW_WATER = 0.75
+
+# the size of the cache is kept as a running total, which is checked
+# against the directory after this many writes since other gizz processes
+# write to it too
+_RESCAN_INTERVAL = 500
+
+class ResponseCache:
+
+    def __init__(self, path, max_size=50 * 1024 * 1024):
+        self._path = path
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._total = None
+        self._writes = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _get_filename(self, identity, url):
+        key = '{}\0{}'.format(identity, url).encode()
+        return os.path.join(self._path, hashlib.sha1(key).hexdigest())
+
+    def get(self, identity, url):
+        filename = self._get_filename(identity, url)
+        try:
+            with open(filename, 'rb') as f:
+                entry = json.loads(f.readline().decode())
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        if entry['url'] != url:
+            return None
+        return entry['headers'], body
+
+    def touch(self, identity, url):
+        # mark an entry as recently used
+        try:
+            os.utime(self._get_filename(identity, url))
+        except OSError:
+            pass
+
+    def put(self, identity, url, headers, body):
+        # entries are written to a temporary file and renamed into place so
+        # that other gizz processes never see a partially written entry
+        filename = self._get_filename(identity, url)
+        try:
+            replaced = os.stat(filename).st_size
+        except OSError:
+            replaced = 0
+        fd, tmp_name = tempfile.mkstemp(dir=self._path, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                entry = {'url': url, 'headers': headers}
+                f.write(json.dumps(entry).encode() + b'\n')
+                f.write(body)
+                size = f.tell()
+            os.replace(tmp_name, filename)
+        except OSError:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            self._writes += 1
+            if self._total is not None:
+                self._total += size - replaced
+            if (self._total is None or self._total > self._max_size or
+                    self._writes >= _RESCAN_INTERVAL):
+                self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        now = time.time()
+        for name in os.listdir(self._path):
+            filename = os.path.join(self._path, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            if name.startswith('.tmp-'):
+                # left behind by a process that was killed while writing
+                if now - st.st_mtime > 3600:
+                    self._unlink(filename)
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+            total += st.st_size
+
+        if total > self._max_size:
+            entries.sort()
+            for _, size, filename in entries:
+                self._unlink(filename)
+                total -= size
+                if total <= self._max_size * _LOW_WATER:
+                    break
+        self._total = total
+        self._writes = 0
+
+    def _unlink(self, filename):
+        try:
+            os.unlink(filename)
+        except OSError:
+            # another process got there first
+            pass
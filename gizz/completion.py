@@ -0,0 +1,55 @@
+# Copyright 2012 Ross Lagerwall
+# This file is part of gizz.
+
+# gizz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# gizz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with gizz.  If not, see <http://www.gnu.org/licenses/>.
+
+# Shell completion. This only needs the argument parser, so none of the
+# modules talking to GitHub are imported.
+
+import gizz.main
+
+_BASH_SCRIPT = r'''_gizz()
+{
+    local IFS=$'\n'
+    COMPREPLY=($(compgen -W "$(gizz --complete "${COMP_WORDS[@]:1:COMP_CWORD-1}")" -- "${COMP_WORDS[COMP_CWORD]}"))
+}
+complete -o default -F _gizz gizz
+'''
+
+def _get_options(parser):
+    return [s for action in parser._actions for s in action.option_strings]
+
+def complete(words):
+    # print the possible next words after words, one per line
+    if words and words[-1] == '--trace':
+        # leave it to the shell to complete a file name
+        return
+    parser, cmd_parsers = gizz.main.build_parser()
+    subcommand = gizz.main.find_subcommand(words)
+    if subcommand is None:
+        candidates = list(gizz.main.COMMANDS) + _get_options(parser)
+    else:
+        candidates = _get_options(cmd_parsers[subcommand])
+    print('\n'.join(candidates))
+
+
+class Cmd_Completion:
+
+    def __init__(self, args):
+        pass
+
+    def run(self):
+        # to enable, add this to ~/.bashrc:
+        #   eval "$(gizz completion)"
+        print(_BASH_SCRIPT, end='')
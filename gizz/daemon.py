@@ -0,0 +1,317 @@
+# Copyright 2012 Ross Lagerwall
+# This file is part of gizz.
+
+# gizz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# gizz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with gizz.  If not, see <http://www.gnu.org/licenses/>.
+
+# A long running process that keeps the connection pool, response cache,
+# git configuration and LazyLoader objects warm between invocations. The
+# command line sends its arguments and working directory over a Unix socket
+# and the daemon runs the command, sending back what it prints and the exit
+# status. Requests are served one at a time because a command runs in the
+# daemon's working directory with its stdout and stderr redirected.
+#
+# Only this module's client half is imported by every invocation, so it
+# must stay cheap to import.
+
+import io
+import json
+import os
+import socket
+import struct
+import sys
+import time
+
+_STATUS = 0
+_STDOUT = 1
+_STDERR = 2
+
+_HEADER = struct.Struct('>BI')
+
+# besides GIT_* and GIZZ_*, the environment variables that change what a
+# command does, which are sent along with it
+_ENVIRONMENT = ('HOME', 'PATH', 'XDG_CONFIG_HOME')
+
+def _is_forwarded(name):
+    return name.startswith(('GIT_', 'GIZZ_')) or name in _ENVIRONMENT
+
+def get_socket_path():
+    runtime_dir = os.getenv('XDG_RUNTIME_DIR')
+    if runtime_dir is None:
+        config_home = os.getenv('XDG_CONFIG_HOME')
+        if config_home is None:
+            config_home = os.path.expanduser('~/.config')
+        runtime_dir = config_home
+    socket_dir = os.path.join(runtime_dir, 'gizz')
+    os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+    return os.path.join(socket_dir, 'daemon.sock')
+
+def _send_frame(sock, stream, data):
+    sock.sendall(_HEADER.pack(stream, len(data)) + data)
+
+def _recv_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise EOFError()
+    return data
+
+def _connect():
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(get_socket_path())
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+def _send_request(sock, request):
+    sock.sendall(json.dumps(request).encode() + b'\n')
+
+def _get_response(sock):
+    # copy the output to ours until the daemon sends the exit status
+    f = sock.makefile('rb')
+    outputs = {_STDOUT: sys.stdout, _STDERR: sys.stderr}
+    while True:
+        stream, size = _HEADER.unpack(_recv_exactly(f, _HEADER.size))
+        data = _recv_exactly(f, size)
+        if stream == _STATUS:
+            return int(data)
+        outputs[stream].flush()
+        outputs[stream].buffer.write(data)
+        outputs[stream].buffer.flush()
+
+def run_in_daemon(argv, args):
+    # Returns the command's exit status, or None if no daemon is running and
+    # the command should be run in this process.
+    sock = _connect()
+    if sock is None:
+        return None
+
+    request = {
+        'argv': argv,
+        'cwd': os.getcwd(),
+        'tty': sys.stdout.isatty(),
+        'trace': os.path.abspath(args.trace) if args.trace else None,
+        'no_cache': args.no_cache,
+        'env': {k: v for k, v in os.environ.items() if _is_forwarded(k)},
+    }
+    try:
+        _send_request(sock, request)
+    except OSError:
+        sock.close()
+        return None
+
+    # a BrokenPipeError here is from writing our own output
+    try:
+        return _get_response(sock)
+    except (EOFError, ConnectionResetError):
+        print('gizz: lost the connection to the daemon', file=sys.stderr)
+        return 1
+    finally:
+        sock.close()
+
+
+class _FrameWriter(io.RawIOBase):
+
+    def __init__(self, sock, stream):
+        self._sock = sock
+        self._stream = stream
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        _send_frame(self._sock, self._stream, bytes(data))
+        return len(data)
+
+
+class Daemon:
+
+    def __init__(self, idle_timeout, session_ttl):
+        self._idle_timeout = idle_timeout
+        self._session_ttl = session_ttl
+        self._session_start = 0
+        self._session_environment = None
+        # by path, as the client's environment may point elsewhere
+        self._caches = {}
+        # the git configuration of each working directory and environment
+        # seen
+        self._contexts = {}
+        self._auths = {}
+
+    def _refresh(self, environment):
+        import gizz.ghlib
+
+        # Objects are kept and shared between requests for a while, after
+        # which they are loaded again in case they have changed on GitHub.
+        # They are never shared between clients with different environments,
+        # which may use another server or token.
+        now = time.monotonic()
+        if (now - self._session_start > self._session_ttl or
+                environment != self._session_environment):
+            gizz.ghlib.new_session(keep=True)
+            self._contexts.clear()
+            self._auths.clear()
+            self._session_start = now
+            self._session_environment = environment
+
+    def _set_environment(self, env):
+        for name in list(os.environ):
+            if _is_forwarded(name) and name not in env:
+                del os.environ[name]
+        os.environ.update(env)
+
+    def _get_cache(self):
+        from gizz.utils import get_cache_path
+        from gizz.cache import ResponseCache
+
+        path = get_cache_path()
+        if path not in self._caches:
+            self._caches[path] = ResponseCache(path)
+        return self._caches[path]
+
+    def _run(self, request):
+        from gizz.main import (build_parser, find_subcommand, get_command,
+                               run_command)
+        from gizz.utils import (set_auth, set_context, AuthTokenAuthorizer,
+                                RepositoryContext)
+        from gizz.trace import Tracer, get_tracer, set_tracer
+        import gizz.ghlib
+
+        argv = request['argv']
+        os.chdir(request['cwd'])
+        # run with the client's environment, so that git and the API
+        # server are the ones it would have used
+        saved_environ = dict(os.environ)
+        try:
+            self._set_environment(request['env'])
+            gizz.ghlib.set_api_url(os.environ.get(
+                    'GIZZ_API_URL', gizz.ghlib.DEFAULT_API_URL))
+            environment = tuple(sorted(request['env'].items()))
+            self._refresh(environment)
+            key = (request['cwd'], environment)
+            if key not in self._contexts:
+                self._contexts[key] = RepositoryContext()
+                self._auths[key] = AuthTokenAuthorizer()
+            set_context(self._contexts[key])
+            set_auth(self._auths[key])
+            gizz.ghlib.set_cache(None if request['no_cache'] else
+                                 self._get_cache())
+            set_tracer(Tracer(request['trace']) if request['trace'] else None)
+            parser, _ = build_parser(find_subcommand(argv))
+            args = parser.parse_args(argv)
+            run_command(get_command(args.subcommand, args))
+        finally:
+            tracer = get_tracer()
+            if tracer is not None:
+                tracer.write()
+                print(tracer.get_summary(), file=sys.stderr)
+            set_tracer(None)
+            os.environ.clear()
+            os.environ.update(saved_environ)
+
+    def _handle(self, sock):
+        line = sock.makefile('rb').readline()
+        if not line:
+            # checking whether a daemon is running
+            return True
+        request = json.loads(line)
+        if request.get('stop'):
+            _send_frame(sock, _STATUS, b'0')
+            return False
+
+        stdout = io.TextIOWrapper(
+                io.BufferedWriter(_FrameWriter(sock, _STDOUT)),
+                line_buffering=request['tty'])
+        stderr = io.TextIOWrapper(_FrameWriter(sock, _STDERR),
+                                  write_through=True)
+        status = 0
+        sys.stdout, sys.stderr = stdout, stderr
+        try:
+            self._run(request)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        finally:
+            try:
+                stdout.flush()
+            finally:
+                sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+        _send_frame(sock, _STATUS, str(status).encode())
+        return True
+
+    def serve(self):
+        path = get_socket_path()
+        if os.path.exists(path):
+            # left behind by a daemon that didn't exit cleanly
+            os.unlink(path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            server.bind(path)
+        finally:
+            os.umask(old_umask)
+        server.listen()
+        if self._idle_timeout:
+            server.settimeout(self._idle_timeout)
+
+        try:
+            while True:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    break
+                conn.settimeout(None)
+                try:
+                    if not self._handle(conn):
+                        break
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client has gone, e.g. its output was piped to head
+                    pass
+                except Exception as e:
+                    # most likely the client went away
+                    print('gizz daemon:', e, file=sys.stderr)
+                finally:
+                    conn.close()
+        finally:
+            server.close()
+            os.unlink(path)
+
+
+class Cmd_Daemon:
+
+    def __init__(self, args):
+        self._args = args
+
+    def run(self):
+        if self._args.stop:
+            sock = _connect()
+            if sock is None:
+                print('No gizz daemon is running', file=sys.stderr)
+                return
+            try:
+                _send_request(sock, {'stop': True})
+                _get_response(sock)
+            finally:
+                sock.close()
+            return
+
+        sock = _connect()
+        if sock is not None:
+            sock.close()
+            print('A gizz daemon is already running', file=sys.stderr)
+            return
+        try:
+            Daemon(self._args.idle_timeout, self._args.session_ttl).serve()
+        except KeyboardInterrupt:
+            pass
@@ -14,15 +14,159 @@
 # You should have received a copy of the GNU General Public License
 # along with gizz.  If not, see <http://www.gnu.org/licenses/>.
 
-import sys
 import json
-import urllib.request
+import os
+import urllib.parse
 import http.client
-import base64
+import codecs
+import collections
+import hashlib
+import queue
+import random
+import re
+import socket
+import threading
+import time
+import weakref
+import zlib
 from gizz.utils import *
+from gizz.ratelimit import RateLimiter
+from gizz.trace import get_tracer, trace_span
 
+DEFAULT_API_URL = 'https://api.github.com'
+SCHEME = 'https'
 HOSTNAME = 'api.github.com'
 
+def set_api_url(url):
+    # use another server implementing the GitHub API, such as a local
+    # stand-in for testing
+    global SCHEME, HOSTNAME
+    parts = urllib.parse.urlsplit(url)
+    SCHEME = parts.scheme
+    HOSTNAME = parts.netloc
+
+if 'GIZZ_API_URL' in os.environ:
+    set_api_url(os.environ['GIZZ_API_URL'])
+
+class _ConnectionPool:
+
+    def __init__(self, max_idle=8):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._max_idle = max_idle
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, scheme, host, connect_timeout=None, fresh=False):
+        # returns a connection and whether it has been used before; with
+        # fresh set, a new one is always made
+        with self._lock:
+            conns = self._idle.get((scheme, host))
+            if conns and not fresh:
+                self.hits += 1
+                return conns.pop(), True
+            self.misses += 1
+        if scheme == 'http':
+            conn = http.client.HTTPConnection(host, timeout=connect_timeout)
+        else:
+            conn = http.client.HTTPSConnection(host, timeout=connect_timeout)
+        return conn, False
+
+    def put(self, scheme, host, conn):
+        with self._lock:
+            conns = self._idle.setdefault((scheme, host), [])
+            if len(conns) < self._max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def get_stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'idle': sum(len(c) for c in self._idle.values())}
+
+
+_pool = _ConnectionPool()
+
+def get_pool_stats():
+    return _pool.get_stats()
+
+_limiter = RateLimiter()
+_MAX_RETRIES = 5
+
+def get_rate_limit_stats():
+    return _limiter.get_stats()
+
+# Requests that fail because of the network, or get one of these from a
+# proxy in front of GitHub, are retried if they are safe to send again
+_TRANSIENT_STATUSES = (500, 502, 503, 504)
+_MAX_RETRY_DELAY = 8.0
+
+def _get_seconds_config(key, default):
+    # 0 means no limit (or off), as for git's own timeouts
+    value = get_context().get_config(key)
+    if value is None:
+        return default
+    try:
+        seconds = float(value)
+    except ValueError:
+        raise InvalidArgumentException('{} must be a number of seconds, not '
+                                       '{!r}'.format(key, value))
+    return seconds if seconds > 0 else None
+
+def _get_timeouts():
+    # how long to wait for a connection to be made and then for each read
+    # from it, set with git config gizz.connecttimeout and gizz.readtimeout
+    return (_get_seconds_config('gizz.connecttimeout', 10.0),
+            _get_seconds_config('gizz.readtimeout', 60.0))
+
+def _get_max_retries():
+    value = get_context().get_config('gizz.retries', '3')
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        raise InvalidArgumentException('gizz.retries must be a number, not '
+                                       '{!r}'.format(value))
+
+def _get_hedge_delay():
+    # a request that is safe to repeat and has had no response after this
+    # long is sent again on another connection and whichever response comes
+    # first is used; off by default as it costs extra requests, set with git
+    # config gizz.hedgedelay
+    return _get_seconds_config('gizz.hedgedelay', None)
+
+def _get_retry_delay(failures):
+    # exponential backoff with jitter so that concurrent requests which
+    # failed together don't all come back at once
+    return random.uniform(0.5, 1.0) * min(0.5 * 2 ** failures,
+                                          _MAX_RETRY_DELAY)
+
+_cache = None
+
+def set_cache(cache):
+    global _cache
+    _cache = cache
+
+def get_cache():
+    return _cache
+
+# response headers recorded in traces
+_TRACED_HEADERS = ('X-RateLimit-Limit', 'X-RateLimit-Remaining',
+                   'X-RateLimit-Reset', 'Retry-After', 'Content-Encoding')
+
+# response headers kept alongside cached bodies
+_CACHED_HEADERS = ('ETag', 'Last-Modified', 'Link', 'Content-Encoding')
+
+
 class _Request:
 
     def __init__(self, location):
@@ -30,7 +174,11 @@ class _Request:
         self._url_params = {}
         self._location = location
         self.method = 'GET'
+        # whether the request can be sent again without changing anything,
+        # which is true of every GET
+        self.idempotent = False
         self._headers = {}
+        self._resp = None
 
     def add_url_param(self, key, param):
         self._url_params[key] = param
@@ -41,40 +189,677 @@ class _Request:
     def add_header(self, k, v):
         self._headers[k] = v
 
-    def perform(self):
+    def perform(self, location=None, stream=False):
+        # with stream set, a successful response body is left unread so that
+        # it can be decoded incrementally by iter_response
         if self.post_object is None:
             json_data = None
         else:
             json_data = json.dumps(self.post_object)
         if json_data:
             self._headers['Content-Length'] = str(len(json_data))
-        location = self._location.format(**self._url_params)
+        if location is None:
+            location = self._location.format(**self._url_params)
         auth_token = get_auth().get_auth_token().encode()
         self._headers['Authorization'] = b'token ' + auth_token
 
         self._headers['User-agent'] = b'gizz'
-        conn = http.client.HTTPSConnection(HOSTNAME)
-        conn.request(self.method, location, body=json_data,
-                     headers=self._headers)
-        resp = conn.getresponse()
-        self._recv_data = resp.read()
+        self._headers['Accept-Encoding'] = 'gzip'
+        headers = dict(self._headers)
+
+        cache = _cache if self.method == 'GET' else None
+        cached = None
+        if cache is not None:
+            identity = hashlib.sha1(auth_token).hexdigest()
+            # the same token may be used with more than one server
+            url = '{}://{}{}'.format(SCHEME, HOSTNAME, location)
+            cached = cache.get(identity, url)
+        if cached is not None:
+            cached_headers, cached_body = cached
+            if 'ETag' in cached_headers:
+                headers['If-None-Match'] = cached_headers['ETag']
+            if 'Last-Modified' in cached_headers:
+                headers['If-Modified-Since'] = cached_headers['Last-Modified']
+
+        idempotent = self.method == 'GET' or self.idempotent
+        max_retries = _get_max_retries() if idempotent else 0
+        attempt = 0
+        failures = 0
+        while True:
+            _limiter.acquire()
+            try:
+                resp = self._send(location, json_data, headers, stream,
+                                  idempotent)
+            except (http.client.HTTPException, OSError) as e:
+                if failures < max_retries:
+                    time.sleep(_get_retry_delay(failures))
+                    failures += 1
+                    continue
+                raise NetworkException(self._get_failure_message(
+                        location, str(e) or type(e).__name__, idempotent))
+            _limiter.update(resp.msg)
+            if self._resp is not None:
+                break
+            if resp.status in _TRANSIENT_STATUSES and failures < max_retries:
+                time.sleep(_get_retry_delay(failures))
+                failures += 1
+                continue
+            # the limiter looks for a message in the (decompressed) body of
+            # an error response
+            body = b''.join(self._iter_body()) if resp.status >= 400 else b''
+            delay = _limiter.get_retry_delay(resp.status, resp.msg, body,
+                                             attempt)
+            if delay is None:
+                break
+            if attempt == _MAX_RETRIES:
+                raise RateLimitException()
+            time.sleep(delay)
+            attempt += 1
+
+        if resp.status in _TRANSIENT_STATUSES:
+            raise ApiException(self._get_failure_message(
+                    location, '{} {}'.format(resp.status, resp.reason),
+                    idempotent))
+        self.status = resp.status
+        self._cache_put = None
+        if cache is None:
+            return
+        if resp.status == 304 and cached is not None:
+            self._recv_data = cached_body
+            self._resp_headers = cached_headers
+            cache.touch(identity, url)
+        elif resp.status == 200 and ('ETag' in resp.msg or
+                                     'Last-Modified' in resp.msg):
+            keep = {k: resp.msg[k] for k in _CACHED_HEADERS if k in resp.msg}
+            if self._resp is None:
+                cache.put(identity, url, keep, self._recv_data)
+            else:
+                # stored once the body has been streamed
+                self._cache_put = lambda body: cache.put(identity, url, keep,
+                                                         body)
+
+    def _get_failure_message(self, location, error, idempotent):
+        msg = '{} {}: {}'.format(self.method, location, error)
+        if not idempotent:
+            # it can't be known whether GitHub acted on it, so it's never
+            # sent again
+            msg += ' (not retried, check whether it took effect)'
+        return msg
+
+    def _send(self, location, json_data, headers, stream, idempotent):
+        name = '{} {}'.format(self.method, location)
+        args = (name, location, json_data, headers, stream)
+        hedge_delay = _get_hedge_delay() if idempotent else None
+        if hedge_delay is not None:
+            conn, resp, body = self._send_hedged(hedge_delay, *args)
+        else:
+            # Anything else goes on a new connection: on an idle one, a
+            # request that fails may have reached the server and could only
+            # be retried by sending it again.
+            conn, resp, body = self._send_once(*args, fresh=not idempotent)
+        self._resp_headers = resp.msg
+        if body is None:
+            self._resp = resp
+            self._conn = conn
+            self._stream_name = name
+        else:
+            self._recv_data = body
+        return resp
+
+    def _send_once(self, name, location, json_data, headers, stream,
+                   fresh=False, hedge=False):
+        # Returns the connection, the response and its body. With stream set
+        # the body of a successful response is left unread and returned as
+        # None, otherwise the connection has already been released.
+        connect_timeout, read_timeout = _get_timeouts()
+        while True:
+            conn, reused = _pool.get(SCHEME, HOSTNAME, connect_timeout,
+                                     fresh)
+            try:
+                with trace_span(name, 'api', reused=reused,
+                                bytes_sent=len(json_data or '')) as span:
+                    if hedge:
+                        span['hedge'] = True
+                    if not reused:
+                        with trace_span('connect', 'api'):
+                            conn.connect()
+                    conn.sock.settimeout(read_timeout)
+                    with trace_span('wait', 'api'):
+                        conn.request(self.method, location, body=json_data,
+                                     headers=headers)
+                        resp = conn.getresponse()
+                    span['status'] = resp.status
+                    for k in _TRACED_HEADERS:
+                        if k in resp.msg:
+                            span[k] = resp.msg[k]
+                    if stream and resp.status == 200:
+                        return conn, resp, None
+                    with trace_span('read', 'api'):
+                        body = resp.read()
+                    span['bytes_received'] = len(body)
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                if reused and not isinstance(e, socket.timeout):
+                    # the server closed an idle connection, try another one
+                    continue
+                raise
+            break
+
+        self._release(conn, resp)
+        return conn, resp, body
+
+    def _send_hedged(self, hedge_delay, *args):
+        # Sends the request on another connection if there's no response
+        # after hedge_delay and returns whichever response comes first. The
+        # other one is thrown away when it arrives.
+        results = queue.Queue()
+        lock = threading.Lock()
+        answered = []
+
+        def send(hedge):
+            try:
+                if hedge:
+                    _limiter.acquire()
+                result = self._send_once(*args, hedge=hedge)
+            except BaseException as e:
+                # whatever it is, it's raised by the caller, which would
+                # otherwise wait for a result forever
+                results.put((None, e))
+                return
+            with lock:
+                first = not answered
+                answered.append(hedge)
+            if first:
+                results.put((result, None))
+            elif result[2] is None:
+                result[0].close()
+
+        threading.Thread(target=send, args=(False,), daemon=True).start()
+        sent = 1
+        try:
+            result, error = results.get(timeout=hedge_delay)
+        except queue.Empty:
+            threading.Thread(target=send, args=(True,), daemon=True).start()
+            sent = 2
+            result, error = results.get()
+        # if one of them failed, wait for the other
+        first_error = error
+        while result is None and sent > 1:
+            sent -= 1
+            result, error = results.get()
+        if result is None:
+            raise first_error
+        return result
+
+    def _release(self, conn, resp):
+        if resp.will_close:
+            conn.close()
+        else:
+            _pool.put(SCHEME, HOSTNAME, conn)
+
+    def _iter_body(self):
+        # yields the decompressed response body in chunks
+        if self._resp_headers.get('Content-Encoding') == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            decompressor = None
+
+        if self._resp is None:
+            chunks = [self._recv_data]
+        else:
+            chunks = self._iter_stream()
+        for chunk in chunks:
+            if decompressor is not None:
+                chunk = decompressor.decompress(chunk)
+            if chunk:
+                yield chunk
+        if decompressor is not None:
+            yield decompressor.flush()
+
+    def _iter_stream(self):
+        resp, conn = self._resp, self._conn
+        self._resp = self._conn = None
+        raw = [] if self._cache_put is not None else None
+        completed = False
+        received = 0
+        read_time = 0.0
+        start = time.perf_counter()
+        try:
+            while True:
+                t = time.perf_counter()
+                try:
+                    chunk = resp.read(_CHUNK_SIZE)
+                except (http.client.HTTPException, OSError) as e:
+                    # part of the list has already been used, so it can't
+                    # simply be requested again
+                    raise NetworkException('{}: {}'.format(
+                            self._stream_name, str(e) or type(e).__name__))
+                read_time += time.perf_counter() - t
+                if not chunk:
+                    if resp.length:
+                        # read(amt) doesn't raise IncompleteRead when the
+                        # connection closes early
+                        raise NetworkException(
+                            '{}: response cut off after {} bytes'.format(
+                                self._stream_name, received))
+                    break
+                received += len(chunk)
+                if raw is not None:
+                    raw.append(chunk)
+                yield chunk
+            completed = True
+        finally:
+            tracer = get_tracer()
+            if tracer is not None:
+                # the body is read as the caller consumes it, so this span
+                # includes the time spent processing the items
+                tracer.add(self._stream_name + ' (body)', 'api', start,
+                           time.perf_counter(),
+                           {'bytes_received': received,
+                            'read_time': read_time,
+                            'completed': completed})
+            if completed:
+                self._release(conn, resp)
+            else:
+                # abandoned part way through the body
+                conn.close()
+        if raw is not None:
+            self._cache_put(b''.join(raw))
 
     def get_response(self):
-        return json.loads(self._recv_data.decode())
+        body = b''.join(self._iter_body())
+        with trace_span('decode', 'json', bytes=len(body)):
+            return json.loads(body)
+
+    def _get_next_location(self):
+        links = self._resp_headers.get('Link')
+        if links is None:
+            return None
+        for url, rel in _link_re.findall(links):
+            if rel == 'next':
+                return urllib.parse.urlsplit(url)._replace(
+                    scheme='', netloc='').geturl()
+        return None
+
+    def iter_response(self):
+        # yields the items of a list response as they are received,
+        # following the Link headers to fetch the remaining pages
+        while True:
+            body = self._iter_body()
+            for item in _iter_json_array(body):
+                yield item
+            # read to the end so that the connection can be reused
+            for _ in body:
+                pass
+            location = self._get_next_location()
+            if location is None:
+                break
+            self.perform(location, stream=True)
+
+
+_CHUNK_SIZE = 64 * 1024
+
+def _iter_json_array(chunks):
+    # incrementally decodes a JSON array from an iterable of bytes, yielding
+    # each element as soon as it has been received
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    eof = False
+    state = 'start'
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n':
+            pos += 1
+        need_more = pos == len(buf)
+        if not need_more and state == 'start':
+            if buf[pos] != '[':
+                # not a list, most likely an error message
+                rest = buf[pos:] + ''.join(text_decoder.decode(c)
+                                           for c in chunks)
+                data = json.loads(rest + text_decoder.decode(b'', True))
+                if isinstance(data, dict) and 'message' in data:
+                    raise ApiException(data['message'])
+                raise ApiException('expected a list')
+            pos += 1
+            state = 'first'
+        elif not need_more and state == 'separator':
+            if buf[pos] == ']':
+                return
+            if buf[pos] != ',':
+                raise ValueError('invalid JSON array')
+            pos += 1
+            state = 'element'
+        elif not need_more:
+            if state == 'first' and buf[pos] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+                # a number at the end of the buffer may be incomplete
+                need_more = end == len(buf) and not eof
+            except ValueError:
+                if eof:
+                    raise
+                need_more = True
+            if not need_more:
+                yield item
+                pos = end
+                state = 'separator'
+
+        if need_more:
+            if eof:
+                raise ValueError('truncated JSON array')
+            chunk = next(chunks, None)
+            buf = buf[pos:]
+            pos = 0
+            if chunk is None:
+                eof = True
+                buf += text_decoder.decode(b'', True)
+            else:
+                buf += text_decoder.decode(chunk)
+
+
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+_MAX_REDIRECTS = 5
+_content_range_re = re.compile(r'bytes (\d+)-\d+/(\d+|\*)')
+
+class _RetryableError(Exception):
+    pass
+
+
+class _Download:
+
+    # Streams a file to path a chunk at a time, via path.part until it is
+    # complete, and returns its sha256 digest. A download that fails part way
+    # through, in this or an earlier run, is picked up where it left off with
+    # a Range request. Redirects, e.g. from the API to codeload.github.com,
+    # are followed but the token is only ever sent to the API server.
+
+    def __init__(self, url, path, sha256=None):
+        self._url = url
+        self._path = path
+        self._part_path = path + '.part'
+        self._sha256 = sha256
+
+    def run(self):
+        if os.path.exists(self._path):
+            # finished by an earlier run
+            with open(self._path, 'rb') as f:
+                self._hash_file(f)
+            return self._check_digest()
+
+        with open(self._part_path, 'ab+') as f:
+            f.seek(0)
+            self._hash_file(f)
+            max_retries = _get_max_retries()
+            failures = 0
+            while True:
+                size = self._size
+                try:
+                    self._fetch(f)
+                    break
+                except (_RetryableError, http.client.HTTPException,
+                        OSError) as e:
+                    if self._size > size:
+                        # it got somewhere, so it's worth carrying on
+                        failures = 0
+                    if failures == max_retries:
+                        raise NetworkException('{}: {}'.format(
+                                self._url, str(e) or type(e).__name__))
+                    time.sleep(_get_retry_delay(failures))
+                    failures += 1
+        try:
+            digest = self._check_digest()
+        except DownloadException:
+            # so that the next attempt starts again
+            os.unlink(self._part_path)
+            raise
+        os.replace(self._part_path, self._path)
+        return digest
+
+    def _hash_file(self, f):
+        self._digest = hashlib.sha256()
+        self._size = 0
+        while True:
+            chunk = f.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            self._digest.update(chunk)
+            self._size += len(chunk)
+
+    def _restart(self, f):
+        f.truncate(0)
+        self._digest = hashlib.sha256()
+        self._size = 0
+
+    def _check_digest(self):
+        digest = self._digest.hexdigest()
+        if self._sha256 is not None and digest != self._sha256.lower():
+            raise DownloadException(self._path, 'expected sha256 {} but got '
+                                    '{}'.format(self._sha256, digest))
+        return digest
+
+    def _fetch(self, f):
+        url = self._url
+        for _ in range(_MAX_REDIRECTS + 1):
+            conn, resp = self._send(url)
+            if resp.status not in _REDIRECT_STATUSES:
+                break
+            url = urllib.parse.urljoin(url, resp.getheader('Location'))
+            resp.read()
+            conn.close()
+        else:
+            conn.close()
+            raise DownloadException(self._path, 'too many redirects')
+
+        try:
+            total = self._get_total(f, resp)
+            if total is None or self._size < total:
+                self._read_body(f, resp, total)
+        finally:
+            conn.close()
+
+    def _send(self, url):
+        parts = urllib.parse.urlsplit(url)
+        headers = {'User-agent': 'gizz', 'Accept-Encoding': 'identity'}
+        if (parts.scheme, parts.netloc) == (SCHEME, HOSTNAME):
+            _limiter.acquire()
+            headers['Authorization'] = 'token ' + get_auth().get_auth_token()
+        if self._size:
+            headers['Range'] = 'bytes={}-'.format(self._size)
+        location = urllib.parse.urlunsplit(('', '') + parts[2:])
+
+        # downloads are long lived, so they get connections of their own
+        connect_timeout, read_timeout = _get_timeouts()
+        conn, _ = _pool.get(parts.scheme, parts.netloc, connect_timeout,
+                            fresh=True)
+        try:
+            with trace_span('GET ' + url, 'api') as span:
+                with trace_span('connect', 'api'):
+                    conn.connect()
+                conn.sock.settimeout(read_timeout)
+                with trace_span('wait', 'api'):
+                    conn.request('GET', location, headers=headers)
+                    resp = conn.getresponse()
+                span['status'] = resp.status
+        except Exception:
+            conn.close()
+            raise
+        if parts.netloc == HOSTNAME:
+            _limiter.update(resp.msg)
+        return conn, resp
+
+    def _get_total(self, f, resp):
+        # Returns the size of the whole file, if the server says, after
+        # checking that the response carries on from what has already been
+        # written.
+        if resp.status == 200:
+            if self._size:
+                # the server doesn't do ranges
+                self._restart(f)
+            length = resp.getheader('Content-Length')
+            return int(length) if length is not None else None
+        if resp.status == 206:
+            m = _content_range_re.match(resp.getheader('Content-Range', ''))
+            if m is None or int(m.group(1)) != self._size:
+                self._restart(f)
+                raise _RetryableError('unexpected range in response')
+            return int(m.group(2)) if m.group(2) != '*' else None
+        if resp.status == 416:
+            # nothing after what we've got, which is either all of it or
+            # something else
+            total = resp.getheader('Content-Range', '').rpartition('/')[2]
+            if total.isdigit() and int(total) == self._size:
+                return self._size
+            self._restart(f)
+            raise _RetryableError('416 Range Not Satisfiable')
+        error = '{} {}'.format(resp.status, resp.reason)
+        if resp.status in _TRANSIENT_STATUSES:
+            raise _RetryableError(error)
+        raise DownloadException(self._path, error)
+
+    def _read_body(self, f, resp, total):
+        received = 0
+        with trace_span('read', 'api') as span:
+            try:
+                while True:
+                    chunk = resp.read(_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    self._digest.update(chunk)
+                    self._size += len(chunk)
+                    received += len(chunk)
+            finally:
+                # what has been written is kept for the next attempt
+                f.flush()
+                span['bytes_received'] = received
+        if total is not None and self._size != total:
+            raise _RetryableError('expected {} bytes but got {}'.format(
+                    total, self._size))
+
+
+_link_re = re.compile(r'<([^>]*)>;\s*rel="(\w+)"')
+
+_MAX_POLL_DELAY = 16.0
+
+
+def _get_backend():
+    # either 'rest' or 'graphql', set with git config gizz.backend
+    return get_context().get_config('gizz.backend', 'rest')
+
+def _graphql_query(query, variables):
+    r = _Request('/graphql')
+    r.method = 'POST'
+    # only queries are sent, never mutations
+    r.idempotent = True
+    r.set_post_data({'query': query, 'variables': variables})
+    r.perform()
+    data = r.get_response()
+    if data.get('errors'):
+        raise ApiException(data['errors'][0]['message'])
+    return data['data']
+
+
+_PULL_REQUESTS_QUERY = '''
+query($owner: String!, $name: String!, $states: [PullRequestState!],
+      $first: Int!, $after: String, $comments: Boolean!) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(states: $states, first: $first, after: $after,
+                 orderBy: {field: CREATED_AT, direction: DESC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number state title body createdAt updatedAt mergeable
+        author { login }
+        headRefName headRefOid
+        headRepositoryOwner { login }
+        headRepository { name url }
+        baseRefName baseRefOid
+        comments(first: 100) @include(if: $comments) {
+          pageInfo { hasNextPage }
+          nodes { author { login } body }
+        }
+      }
+    }
+  }
+}
+'''
+
+_GRAPHQL_MERGEABLE = {'MERGEABLE': True, 'CONFLICTING': False}
+
+
+class _Session:
+
+    # Maps the API path of each resource to the one object representing it,
+    # so that a resource is loaded at most once however many times it is
+    # referred to. Objects nothing else refers to any more are dropped, so
+    # that streaming through a long listing doesn't keep all of it, unless
+    # the session keeps them, as the daemon's do so that objects stay loaded
+    # from one command to the next.
+
+    def __init__(self, keep=False):
+        self._lock = threading.Lock()
+        self._objects = weakref.WeakValueDictionary()
+        self._kept = [] if keep else None
+
+    def get(self, cls, path):
+        with self._lock:
+            obj = self._objects.get(path)
+            if obj is None:
+                obj = object.__new__(cls)
+                obj._load_lock = threading.RLock()
+                self._objects[path] = obj
+                if self._kept is not None:
+                    self._kept.append(obj)
+            return obj
+
+
+_session = _Session()
+
+def new_session(keep=False):
+    global _session
+    _session = _Session(keep)
 
 
 class LazyLoader:
 
+    # The models use __slots__ to keep large listings small. An attribute
+    # that hasn't been set is loaded, unless it has a value in _defaults.
+    __slots__ = ('_load_lock', '_loaded', '__weakref__')
+
+    _defaults = {'_loaded': False}
+
+    def __new__(cls, *args, **kwargs):
+        return _session.get(cls, cls._get_path(*args, **kwargs))
+
     def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        defaults = type(self)._defaults
+        if name in defaults:
+            return defaults[name]
         # the class doesn't have the attribute so try and load it from the
-        # remote store
-        self._load()
+        # remote store; concurrent accesses wait for the first load rather
+        # than making their own requests
+        with self._load_lock:
+            if not self._loaded:
+                self._load()
+                self._loaded = True
 
         return self.__getattribute__(name)
 
 
 class User(LazyLoader):
 
+    __slots__ = ('username', 'name', 'following')
+
+    _repo_list_location = '/users/{user}/repos?per_page={per_page}'
+
+    @staticmethod
+    def _get_path(username, data=None):
+        return '/users/{}'.format(username).lower()
+
     def __init__(self, username, data=None):
         self.username = username
         if data is not None:
@@ -91,22 +876,49 @@ class User(LazyLoader):
         data = r.get_response()
         self._load_from_data(data)
 
-    def get_repo_list(self):
-        r = _Request('/users/{user}/repos')
+    def get_repo_list(self, per_page=100):
+        r = _Request(self._repo_list_location)
         r.add_url_param('user', self.username)
-        r.perform()
-        repos_data = r.get_response()
+        r.add_url_param('per_page', per_page)
+        r.perform(stream=True)
+
+        for repo_data in r.iter_response():
+            yield Repository(self, repo_data['name'], repo_data)
+
+
+class Organization(User):
 
-        repos = []
-        for repo_data in repos_data:
-            repo = Repository(self, repo_data['name'], repo_data)
-            repos.append(repo)
-            
-        return repos
+    __slots__ = ()
+
+    _repo_list_location = '/orgs/{user}/repos?per_page={per_page}'
+
+    @staticmethod
+    def _get_path(username, data=None):
+        return '/orgs/{}'.format(username).lower()
+
+    def _load_from_data(self, data):
+        self.name = data['name']
+        self.following = 0
+
+    def _load(self):
+        r = _Request('/orgs/{user}')
+        r.add_url_param('user', self.username)
+        r.perform()
+        data = r.get_response()
+        self._load_from_data(data)
 
 
 class Repository(LazyLoader):
 
+    __slots__ = ('user', 'reponame', 'git_url', 'clone_url', 'ssh_url',
+                 'description', '_parent_data', '_parent')
+
+    _defaults = dict(LazyLoader._defaults, _parent=None)
+
+    @staticmethod
+    def _get_path(user, reponame, data=None):
+        return '/repos/{}/{}'.format(user.username, reponame).lower()
+
     def __init__(self, user, reponame, data=None):
         self.user = user
         self.reponame = reponame
@@ -115,12 +927,22 @@ class Repository(LazyLoader):
 
     def _load_from_data(self, data):
         self.git_url = data['git_url']
+        self.clone_url = data['clone_url']
         self.ssh_url = data['ssh_url']
         self.description = data['description']
-        if 'parent' in data:
-            u = User(data['parent']['owner']['login'])
-            self.parent = Repository(u, data['parent']['name'], data['parent'])
-            
+        self._parent_data = data.get('parent')
+        self._parent = None
+
+    @property
+    def parent(self):
+        # made when first asked for rather than for every repo in a list
+        if self._parent is None:
+            data = self._parent_data
+            if data is None:
+                raise AttributeError('parent')
+            self._parent = Repository(User(data['owner']['login']),
+                                      data['name'], data)
+        return self._parent
 
     def _load(self):
         r = _Request('/repos/{user}/{repo}')
@@ -130,58 +952,173 @@ class Repository(LazyLoader):
         data = r.get_response()
         self._load_from_data(data)
 
-    def get_branch_list(self):
-        r = _Request('/repos/{user}/{repo}/branches')
+    def get_branch_list(self, per_page=100):
+        r = _Request('/repos/{user}/{repo}/branches?per_page={per_page}')
         r.add_url_param('user', self.user.username)
         r.add_url_param('repo', self.reponame)
-        r.perform()
-        branches_data = r.get_response()
+        r.add_url_param('per_page', per_page)
+        r.perform(stream=True)
 
-        branches = []
-        for branch_data in branches_data:
+        for branch_data in r.iter_response():
             branch = Branch(self, branch_data['name'])
             branch.sha = branch_data['commit']['sha']
-            branches.append(branch)
+            yield branch
 
-        return branches
+    def download_tarball(self, ref, path, sha256=None):
+        # returns the sha256 digest of the downloaded archive
+        url = '{}://{}/repos/{}/{}/tarball/{}'.format(
+                SCHEME, HOSTNAME, self.user.username, self.reponame,
+                urllib.parse.quote(ref))
+        return _Download(url, path, sha256).run()
 
-    def get_tag_list(self):
-        r = _Request('/repos/{user}/{repo}/tags')
+    def get_tag_list(self, per_page=100):
+        r = _Request('/repos/{user}/{repo}/tags?per_page={per_page}')
         r.add_url_param('user', self.user.username)
         r.add_url_param('repo', self.reponame)
-        r.perform()
-        tags_data = r.get_response()
+        r.add_url_param('per_page', per_page)
+        r.perform(stream=True)
 
-        tags = []
-        for tag_data in tags_data:
-            tag = Tag(self, tag_data['name'],
+        for tag_data in r.iter_response():
+            yield Tag(self, tag_data['name'],
                             tag_data['commit']['sha'],
                             tag_data['tarball_url'])
-            tags.append(tag)
 
-        return tags
-
-    def get_pull_request_list(self, closed=False):
-        r = _Request('/repos/{user}/{repo}/pulls?state={state}')
+    def get_pull_request_list(self, closed=False, per_page=100,
+                              comments=False):
+        # comments is a hint that the comments will be needed, which lets
+        # the graphql backend get them in the same query
+        if _get_backend() == 'graphql':
+            yield from self._get_pull_request_list_graphql(closed, per_page,
+                                                           comments)
+            return
+
+        r = _Request('/repos/{user}/{repo}/pulls?state={state}'
+                     '&per_page={per_page}')
         r.add_url_param('user', self.user.username)
         r.add_url_param('repo', self.reponame)
         r.add_url_param('state', 'closed' if closed else 'open')
-        r.perform()
-        pull_reqs_data = r.get_response()
-
-        pull_reqs = []
-        for pull_req_data in pull_reqs_data:
-            pull_req = PullRequest(self, pull_req_data['number'],
-                                   pull_req_data['title'],
-                                   pull_req_data['body'])
-            pull_reqs.append(pull_req)
-
-        return pull_reqs
+        r.add_url_param('per_page', per_page)
+        r.perform(stream=True)
+
+        for pull_req_data in r.iter_response():
+            yield PullRequest(self, pull_req_data['number'],
+                              data=pull_req_data)
+
+    def _get_pull_request_list_graphql(self, closed, per_page, comments):
+        variables = {'owner': self.user.username,
+                     'name': self.reponame,
+                     'states': ['CLOSED', 'MERGED'] if closed else ['OPEN'],
+                     'first': min(per_page, 100),
+                     'after': None,
+                     'comments': comments}
+        while True:
+            data = _graphql_query(_PULL_REQUESTS_QUERY, variables)
+            pull_reqs = data['repository']['pullRequests']
+            for node in pull_reqs['nodes']:
+                yield self._pull_request_from_graphql(node)
+            if not pull_reqs['pageInfo']['hasNextPage']:
+                break
+            variables['after'] = pull_reqs['pageInfo']['endCursor']
+
+    def _pull_request_from_graphql(self, node):
+        # map the graphql node onto the fields of the REST response
+        owner = node['headRepositoryOwner']
+        head_repo = node['headRepository']
+        # deleted accounts are shown as ghost
+        head_user = owner['login'] if owner else 'ghost'
+        author = node['author']['login'] if node['author'] else 'ghost'
+        if head_repo is None:
+            head_repo_data = None
+        else:
+            # there's no git_url in graphql, but the repository's url can
+            # be fetched from just the same
+            head_repo_data = {'name': head_repo['name'],
+                              'git_url': head_repo['url']}
+        data = {'title': node['title'],
+                'body': node['body'],
+                'user': {'login': author},
+                'created_at': node['createdAt'],
+                'updated_at': node['updatedAt'],
+                'mergeable': _GRAPHQL_MERGEABLE.get(node['mergeable']),
+                'state': 'open' if node['state'] == 'OPEN' else 'closed',
+                'merged': node['state'] == 'MERGED',
+                'head': {'user': {'login': head_user},
+                         'repo': head_repo_data,
+                         'ref': node['headRefName'],
+                         'sha': node['headRefOid']},
+                'base': {'ref': node['baseRefName'],
+                         'sha': node['baseRefOid']}}
+        pr = PullRequest(self, node['number'], data=data)
+
+        comments = node.get('comments')
+        if comments is not None and not comments['pageInfo']['hasNextPage']:
+            pr._comments = []
+            for c in comments['nodes']:
+                login = c['author']['login'] if c['author'] else 'ghost'
+                pr._comments.append(PullRequestComment(pr, User(login),
+                                                       c['body'].strip()))
+        return pr
+
+    def fetch_pull_requests(self, pull_reqs, remote=None):
+        # fetch the heads of several pull requests with a single git fetch
+        # of refs/pull/<id>/head from this repository, without adding a
+        # remote for each contributor
+        pull_reqs = list(pull_reqs)
+        if not pull_reqs:
+            return []
+        ref_prefix = 'refs/gizz/{}/{}/pull/'.format(self.user.username,
+                                                    self.reponame)
+        refspecs = ['+refs/pull/{0}/head:{1}{0}'.format(pr.id, ref_prefix)
+                    for pr in pull_reqs]
+        # GitHub doesn't serve git:// any more, so the https url is used
+        git_run('fetch', remote or self.clone_url, *refspecs)
+
+        # the branches are created together in a single transaction
+        refs = GitRefs()
+        branches = []
+        for pr in pull_reqs:
+            branch_name = refs.pick_branch_name(pr._get_branch_names())
+            refs.create_branch(branch_name, refs.get(ref_prefix + str(pr.id)))
+            branches.append((pr, branch_name))
+        refs.commit()
+        return branches
 
     def get_pull_request(self, id):
         pull_req = PullRequest(self, id)
         return pull_req
 
+    def get_pull_request_updates(self, since=None, per_page=100):
+        # yields the data of the pull requests in any state, most recently
+        # updated first, stopping at those last updated before since
+        r = _Request('/repos/{user}/{repo}/pulls?state=all&sort=updated'
+                     '&direction=desc&per_page={per_page}')
+        r.add_url_param('user', self.user.username)
+        r.add_url_param('repo', self.reponame)
+        r.add_url_param('per_page', per_page)
+        r.perform(stream=True)
+
+        for pull_req_data in r.iter_response():
+            if since is not None and pull_req_data['updated_at'] < since:
+                break
+            yield pull_req_data
+
+    def get_comment_updates(self, since=None, per_page=100):
+        # yields the data of the issue and pull request comments updated
+        # since since, oldest first
+        location = ('/repos/{user}/{repo}/issues/comments?sort=updated'
+                    '&direction=asc&per_page={per_page}')
+        if since is not None:
+            location += '&since={since}'
+        r = _Request(location)
+        r.add_url_param('user', self.user.username)
+        r.add_url_param('repo', self.reponame)
+        r.add_url_param('per_page', per_page)
+        r.add_url_param('since', since)
+        r.perform(stream=True)
+
+        for comment_data in r.iter_response():
+            yield comment_data
+
     def fork(self):
         r = _Request('/repos/{user}/{repo}/forks')
         r.add_url_param('user', self.user.username)
@@ -208,6 +1145,8 @@ class Repository(LazyLoader):
 
 class Branch:
 
+    __slots__ = ('repo', 'name', 'sha', 'git_url')
+
     def __init__(self, repo, name):
         self.repo = repo
         self.name = name
@@ -235,6 +1174,8 @@ class Branch:
 
 class Tag:
 
+    __slots__ = ('repo', 'name', 'sha', 'tarball_url')
+
     def __init__(self, repo, name, sha, tarball_url):
         self.repo = repo
         self.name = name
@@ -245,30 +1186,84 @@ class Tag:
         print(self.repo, self.name, self.sha)
         print(self.tarball_url)
 
+    def download(self, path, sha256=None):
+        return _Download(self.tarball_url, path, sha256).run()
+
 
 class PullRequest(LazyLoader):
 
-    def __init__(self, repo, id, title=None, body=None):
+    __slots__ = ('repo', 'id', 'title', 'body', 'author', 'create_date',
+                 'update_date', 'mergeable', 'state', 'merged', '_head_data',
+                 '_base_data', '_head', '_base', '_comments', '_etag')
+
+    # _comments are those prefetched along with the pull request and _etag
+    # is of the last full response, for polling with conditional requests
+    _defaults = dict(LazyLoader._defaults, _head=None, _base=None,
+                     _comments=None, _etag=None)
+
+    @staticmethod
+    def _get_path(repo, id, title=None, body=None, data=None):
+        return '/repos/{}/{}/pulls/{}'.format(repo.user.username,
+                                              repo.reponame, id).lower()
+
+    def __init__(self, repo, id, title=None, body=None, data=None):
         self.repo = repo
         self.id = id
         if title is not None:
             self.title = title
         if body is not None:
             self.body = body
+        if data is not None:
+            self._load_from_data(data)
 
     def _load_from_data(self, data):
         self.title = data['title']
         self.body = data['body']
+        # who opened it, who needn't own the head repository
+        self.author = data['user']['login']
         self.create_date = data['created_at']
-        self.mergeable = data['mergeable']
-
-        head_repo = Repository(User(data['head']['user']['login']),
-                               data['head']['repo']['name'])
-        self.head = Branch(head_repo, data['head']['ref'])
-        self.head.sha = data['head']['sha']
-        self.head.git_url = data['head']['repo']['git_url']
-        self.base = Branch(self.repo, data['base']['ref'])
-        self.base.sha = data['base']['sha']
+        self.update_date = data.get('updated_at')
+        # not included in list responses, in which case it gets loaded
+        # lazily
+        if 'mergeable' in data:
+            self.mergeable = data['mergeable']
+        # 'open' or 'closed', and whether a closed one was merged
+        if 'state' in data:
+            self.state = data['state']
+        if 'merged' in data:
+            self.merged = data['merged']
+
+        # only what's needed for head and base, which are made when first
+        # asked for
+        head_data = data['head']
+        head_repo_data = head_data['repo']
+        if head_repo_data is None:
+            # the head repository has been deleted
+            head_repo_data = {'name': None, 'git_url': None}
+        self._head_data = (head_data['user']['login'], head_repo_data['name'],
+                           head_repo_data['git_url'], head_data['ref'],
+                           head_data['sha'])
+        self._base_data = (data['base']['ref'], data['base']['sha'])
+        self._head = self._base = None
+
+    @property
+    def head(self):
+        if self._head is None:
+            username, reponame, git_url, ref, sha = self._head_data
+            head = Branch(Repository(User(username), reponame), ref)
+            head.sha = sha
+            head.git_url = git_url
+            self._head = head
+        return self._head
+
+    @property
+    def base(self):
+        if self._base is None:
+            ref, sha = self._base_data
+            base = Branch(self.repo, ref)
+            base.sha = sha
+            self._base = base
+        return self._base
 
     def _load(self):
         r = _Request('/repos/{user}/{repo}/pulls/{id}')
@@ -279,48 +1274,83 @@ class PullRequest(LazyLoader):
         data = r.get_response()
         self._load_from_data(data)
 
-    def fetch(self):
+    def poll_mergeable(self):
+        # load the pull request again unless it hasn't changed, returning
+        # whether it can be merged or None if GitHub hasn't worked that out
+        r = _Request('/repos/{user}/{repo}/pulls/{id}')
+        r.add_url_param('user', self.repo.user.username)
+        r.add_url_param('repo', self.repo.reponame)
+        r.add_url_param('id', self.id)
+        if self._etag is not None:
+            r.add_header('If-None-Match', self._etag)
+        r.perform()
+        # with the response cache, a 304 for a request without our ETag has
+        # the cached body
+        if r.status != 304 or self._etag is None:
+            self._load_from_data(r.get_response())
+            self._etag = r._resp_headers.get('ETag')
+            self._loaded = True
+        return self.mergeable
+
+    def add_remote(self):
+        # add the head repository as a remote named after its owner
         username = self.head.repo.user.username
-        try:
-            git_run('remote', 'add', username, self.head.git_url)
-        except subprocess.CalledProcessError:
-            # ignore if username already exists
-            pass
-        git_run('fetch', username)
-        try:
-            git_run('branch', self.head.name,
-                    '{}/{}'.format(username, self.head.name))
-            return self.head.name
-        except subprocess.CalledProcessError:
+        if get_context().get_config('remote.{}.url'.format(username)) is None:
             try:
-                branch_name = username + '-' + self.head.name
-                git_run('branch', branch_name,
-                        '{}/{}'.format(username, self.head.name))
-                return branch_name
+                git_run('remote', 'add', username, self.head.git_url)
             except subprocess.CalledProcessError:
-                branch_count = 0
-                while True:
-                    branch_count += 1
-                    branch_name = '{}-{}-{}'.format(username,
-                                                    self.head.name,
-                                                    branch_count)
-                    try:
-                        git_run('branch', branch_name,
-                                '{}/{}'.format(username, self.head.name))
-                        return branch_name
-                    except subprocess.CalledProcessError:
-                        pass
+                # ignore if username already exists
+                pass
+        return username
 
-    def get_comments(self):
-        r = _Request('/repos/{user}/{repo}/issues/{id}/comments')
+    def fetch(self):
+        username = self.add_remote()
+        git_run('fetch', username)
+        return self._create_branch(GitRefs(),
+                                   '{}/{}'.format(username, self.head.name))
+
+    def _get_branch_names(self):
+        # the names tried in turn for the local branch of the pull request
+        username = self.head.repo.user.username
+        yield self.head.name
+        yield '{}-{}'.format(username, self.head.name)
+        branch_count = 0
+        while True:
+            branch_count += 1
+            yield '{}-{}-{}'.format(username, self.head.name, branch_count)
+
+    def _create_branch(self, refs, start_point):
+        # create a local branch for the head of the pull request, picking a
+        # name that isn't taken yet. git branch is used rather than adding
+        # it to the refs transaction so that it tracks the remote branch.
+        branch_name = refs.pick_branch_name(self._get_branch_names())
+        git_run('branch', branch_name, start_point)
+        return branch_name
+
+    def get_comment_updates(self, since=None, per_page=100):
+        # yields the data of the comments updated since since, or of all of
+        # them, oldest first
+        location = ('/repos/{user}/{repo}/issues/{id}/comments'
+                    '?per_page={per_page}')
+        if since is not None:
+            location += '&since={since}'
+        r = _Request(location)
         r.add_url_param('user', self.repo.user.username)
         r.add_url_param('repo', self.repo.reponame)
         r.add_url_param('id', self.id)
-        r.perform()
-        data = r.get_response()
-        comments = []
+        r.add_url_param('per_page', per_page)
+        r.add_url_param('since', since)
+        r.perform(stream=True)
+
+        for comment_data in r.iter_response():
+            yield comment_data
 
-        for c in data:
+    def get_comments(self):
+        if self._comments is not None:
+            return self._comments
+
+        comments = []
+        for c in self.get_comment_updates():
             comments.append(PullRequestComment(self, User(c['user']['login']),
                                                c['body'].strip()))
         return comments
@@ -342,7 +1372,80 @@ class PullRequest(LazyLoader):
 
 class PullRequestComment:
 
+    __slots__ = ('pr', 'user', 'body')
+
     def __init__(self, pr, user, body):
         self.pr = pr
         self.user = user
         self.body = body
+
+
+def wait_for_mergeable(pull_reqs, timeout, jobs):
+    # yields (pull request, mergeable) for each of pull_reqs as soon as
+    # GitHub has worked out whether it can be merged, and with None for
+    # those it hasn't after timeout seconds. They are polled together, up to
+    # jobs at a time, with conditional requests and exponential backoff.
+    # GitHub never works it out for closed ones, which are yielded with
+    # False straight away.
+    pending = list(pull_reqs)
+    deadline = time.monotonic() + timeout
+    delay = 1.0
+    while True:
+        polled = ordered_map(lambda pr: (pr, pr.poll_mergeable()), pending,
+                             jobs)
+        pending = []
+        for pr, mergeable in polled:
+            if pr.state != 'open':
+                yield pr, False
+            elif mergeable is None:
+                pending.append(pr)
+            else:
+                yield pr, mergeable
+        remaining = deadline - time.monotonic()
+        if not pending or remaining <= 0:
+            break
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, _MAX_POLL_DELAY)
+
+    for pr in pending:
+        yield pr, None
+
+def fetch_pull_requests_from_remotes(pull_reqs, jobs, progress=None):
+    # fetch the heads of several pull requests from their contributors'
+    # repositories, fetching each remote once and up to jobs remotes at a
+    # time; progress is called with (remote, error) as each fetch completes
+    # returns a list of (pull request, branch name) and a dict mapping the
+    # remotes that failed to their errors
+    remotes = collections.OrderedDict()
+    errors = {}
+    for pr in pull_reqs:
+        username = pr.head.repo.user.username
+        if pr.head.git_url is None:
+            errors[username] = 'repository deleted'
+            continue
+        if username not in remotes:
+            pr.add_remote()
+        remotes.setdefault(username, []).append(pr)
+
+    fetched = set()
+    for remote, error in git_fetch_remotes(remotes, jobs):
+        if error is None:
+            fetched.add(remote)
+        else:
+            errors[remote] = error
+        if progress is not None:
+            progress(remote, error)
+
+    refs = GitRefs()
+    branches = []
+    for remote, remote_pull_reqs in remotes.items():
+        if remote not in fetched:
+            continue
+        for pr in remote_pull_reqs:
+            start_point = '{}/{}'.format(remote, pr.head.name)
+            try:
+                branches.append((pr, pr._create_branch(refs, start_point)))
+            except subprocess.CalledProcessError:
+                errors[remote] = 'no branch {}'.format(pr.head.name)
+    branches.sort(key=lambda b: b[0].id)
+    return branches, errors
@@ -0,0 +1,237 @@
+# Copyright 2012 Ross Lagerwall
+# This file is part of gizz.
+
+# gizz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# gizz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with gizz.  If not, see <http://www.gnu.org/licenses/>.
+
+# A local SQLite mirror of the pull requests and comments of repositories,
+# kept up to date incrementally by gizz sync so that listings can be answered
+# without any API calls.
+
+import json
+import sqlite3
+import threading
+import gizz.ghlib
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pull_requests (
+    repo TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    author TEXT,
+    head_ref TEXT,
+    base_ref TEXT,
+    updated_at TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (repo, number)
+);
+CREATE INDEX IF NOT EXISTS pull_requests_state
+    ON pull_requests (repo, state);
+CREATE TABLE IF NOT EXISTS comments (
+    repo TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    author TEXT,
+    body TEXT,
+    created_at TEXT,
+    updated_at TEXT,
+    PRIMARY KEY (repo, id)
+);
+CREATE INDEX IF NOT EXISTS comments_number ON comments (repo, number);
+CREATE TABLE IF NOT EXISTS comment_state (
+    repo TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    pr_updated_at TEXT,
+    comments_since TEXT,
+    PRIMARY KEY (repo, number)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    repo TEXT PRIMARY KEY,
+    pull_requests_since TEXT,
+    comments_since TEXT
+);
+'''
+
+def _trim_pull_request(data):
+    # keep only what PullRequest needs, list responses include the full
+    # head and base repositories
+    head = data['head']
+    if head['repo'] is None:
+        head_repo = None
+    else:
+        head_repo = {'name': head['repo']['name'],
+                     'git_url': head['repo']['git_url']}
+    return {'number': data['number'],
+            'state': data['state'],
+            'title': data['title'],
+            'body': data['body'],
+            'user': {'login': data['user']['login']},
+            'created_at': data['created_at'],
+            'updated_at': data['updated_at'],
+            'mergeable': data.get('mergeable'),
+            'head': {'user': {'login': head['user']['login']},
+                     'repo': head_repo,
+                     'ref': head['ref'],
+                     'sha': head['sha']},
+            'base': {'ref': data['base']['ref'],
+                     'sha': data['base']['sha']}}
+
+def _get_issue_number(comment):
+    return int(comment['issue_url'].rsplit('/', 1)[1])
+
+
+class PullRequestIndex:
+
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        with self._get_conn() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _get_conn(self):
+        # sqlite connections can't be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def _get_sync_state(self, repo_name):
+        row = self._get_conn().execute(
+            'SELECT pull_requests_since, comments_since FROM sync_state '
+            'WHERE repo = ?', (repo_name,)).fetchone()
+        return row if row is not None else (None, None)
+
+    def sync(self, repo):
+        # fetches the pull requests and comments of repo updated since the
+        # last sync; returns how many of each were updated
+        repo_name = str(repo).lower()
+        prs_since, comments_since = self._get_sync_state(repo_name)
+        conn = self._get_conn()
+
+        num_prs = 0
+        with conn:
+            for data in repo.get_pull_request_updates(prs_since):
+                conn.execute(
+                    'INSERT OR REPLACE INTO pull_requests VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?, ?)',
+                    (repo_name, data['number'], data['state'],
+                     data['user']['login'], data['head']['ref'],
+                     data['base']['ref'], data['updated_at'],
+                     json.dumps(_trim_pull_request(data))))
+                if prs_since is None or data['updated_at'] > prs_since:
+                    prs_since = data['updated_at']
+                num_prs += 1
+
+        numbers = {row[0] for row in conn.execute(
+                'SELECT number FROM pull_requests WHERE repo = ?',
+                (repo_name,))}
+        num_comments = 0
+        with conn:
+            for c in repo.get_comment_updates(comments_since):
+                if comments_since is None or c['updated_at'] > comments_since:
+                    comments_since = c['updated_at']
+                number = _get_issue_number(c)
+                if number not in numbers:
+                    # a comment on an issue
+                    continue
+                self._put_comment(conn, repo_name, number, c)
+                num_comments += 1
+
+            conn.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)',
+                         (repo_name, prs_since, comments_since))
+        return num_prs, num_comments
+
+    def _put_comment(self, conn, repo_name, number, c):
+        conn.execute('INSERT OR REPLACE INTO comments VALUES '
+                     '(?, ?, ?, ?, ?, ?, ?)',
+                     (repo_name, number, c['id'], c['user']['login'],
+                      c['body'], c['created_at'], c['updated_at']))
+
+    def get_comments(self, pr):
+        # Returns the comments on pr, fetching only those added or edited
+        # since the last call, and none at all if the pull request hasn't
+        # been updated since. Like sync, this doesn't notice deletions.
+        if pr._comments is not None:
+            return pr._comments
+
+        repo_name = str(pr.repo).lower()
+        conn = self._get_conn()
+        row = conn.execute(
+            'SELECT pr_updated_at, comments_since FROM comment_state '
+            'WHERE repo = ? AND number = ?', (repo_name, pr.id)).fetchone()
+        pr_updated_at, since = row if row is not None else (None, None)
+        if (row is None or pr.update_date is None or
+            pr.update_date != pr_updated_at):
+            with conn:
+                for c in pr.get_comment_updates(since):
+                    self._put_comment(conn, repo_name, pr.id, c)
+                    if since is None or c['updated_at'] > since:
+                        since = c['updated_at']
+                conn.execute('INSERT OR REPLACE INTO comment_state VALUES '
+                             '(?, ?, ?, ?)',
+                             (repo_name, pr.id, pr.update_date, since))
+
+        return [gizz.ghlib.PullRequestComment(pr, gizz.ghlib.User(login),
+                                              body.strip())
+                for login, body in self.get_comment_data(pr.repo, pr.id)]
+
+    def is_synced(self, repo):
+        # the cursors are still None after syncing a repo with nothing in it
+        return self._get_conn().execute(
+            'SELECT 1 FROM sync_state WHERE repo = ?',
+            (str(repo).lower(),)).fetchone() is not None
+
+    def get_pull_request_data(self, repo, closed=False, number=None,
+                              author=None, branch=None):
+        # returns the stored data of the matching pull requests, newest first
+        query = 'SELECT data FROM pull_requests WHERE repo = ?'
+        params = [str(repo).lower()]
+        if number is not None:
+            query += ' AND number = ?'
+            params.append(number)
+        else:
+            query += ' AND state = ?'
+            params.append('closed' if closed else 'open')
+        if author is not None:
+            query += ' AND author = ? COLLATE NOCASE'
+            params.append(author)
+        if branch is not None:
+            query += ' AND base_ref = ?'
+            params.append(branch)
+        query += ' ORDER BY number DESC'
+        return [json.loads(row[0])
+                for row in self._get_conn().execute(query, params)]
+
+    def get_comment_data(self, repo, number):
+        # returns (author, body) of the comments on a pull request in the
+        # order they were made
+        return self._get_conn().execute(
+            'SELECT author, body FROM comments WHERE repo = ? AND number = ? '
+            'ORDER BY created_at, id', (str(repo).lower(), number)).fetchall()
+
+    def get_pull_request_list(self, repo, closed=False, number=None,
+                              author=None, branch=None, comments=False):
+        # builds PullRequest objects from the index, with their comments if
+        # comments is set
+        pull_reqs = []
+        for data in self.get_pull_request_data(repo, closed, number, author,
+                                               branch):
+            pr = gizz.ghlib.PullRequest(repo, data['number'], data=data)
+            if comments:
+                pr._comments = [
+                    gizz.ghlib.PullRequestComment(pr, gizz.ghlib.User(login),
+                                                  body.strip())
+                    for login, body in self.get_comment_data(repo, pr.id)]
+            pull_reqs.append(pr)
+        return pull_reqs
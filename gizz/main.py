@@ -14,102 +14,216 @@
 # You should have received a copy of the GNU General Public License
 # along with gizz.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import sys
 import argparse
-from gizz.builtins import *
+import importlib
+
+def _add_format_argument(cmd):
+    cmd.add_argument('--format', choices=('text', 'ndjson', 'json', 'tsv'),
+                     default='text',
+                     help='output format, one record per item (default: '
+                     'text)')
+
+def _add_list_repos_arguments(cmd):
+    cmd.add_argument('user', type=str, help='list for user',
+                     default=None, nargs='?')
+    _add_format_argument(cmd)
+
+def _add_repo_list_arguments(cmd, what):
+    cmd.add_argument('--repo', type=str, action='append',
+                     help='list {} of REPO, may be given more than '
+                     'once'.format(what))
+    cmd.add_argument('--user', type=str, action='append',
+                     help="list {} of each of USER's repos".format(what))
+    cmd.add_argument('--org', type=str, action='append',
+                     help="list {} of each of ORG's repos".format(what))
+    cmd.add_argument('-j', '--jobs', type=int, default=8,
+                     help='number of concurrent requests (default: 8)')
+    _add_format_argument(cmd)
+
+def _add_list_branches_arguments(cmd):
+    _add_repo_list_arguments(cmd, 'branches')
+
+def _add_list_tags_arguments(cmd):
+    _add_repo_list_arguments(cmd, 'tags')
+
+def _add_download_tag_arguments(cmd):
+    cmd.add_argument('--repo', type=str, help='download tags of REPO')
+    cmd.add_argument('-o', '--output-dir', type=str, default='.',
+                     metavar='DIR',
+                     help='save the archives in DIR (default: the current '
+                     'directory)')
+    cmd.add_argument('--sha256', type=str, action='append',
+                     metavar='[TAG=]DIGEST',
+                     help="check TAG's archive (or the only one's) against "
+                     "DIGEST, may be given more than once")
+    cmd.add_argument('-j', '--jobs', type=int, default=4,
+                     help='number of concurrent downloads (default: 4)')
+    cmd.add_argument('tag', type=str, help='tag to download', nargs='+')
+
+def _add_fork_arguments(cmd):
+    cmd.add_argument('-n', '--no-add',
+                     help="don't add new repository as a remote",
+                     action='store_true')
+    cmd.add_argument('--repo', type=str, help='fork REPO')
+
+def _add_list_pr_arguments(cmd):
+    cmd.add_argument('-v', '--verbose', help='more details',
+                     action='store_true')
+    cmd.add_argument('--closed', help="list closed requests",
+                     action='store_true')
+    cmd.add_argument('-c', '--comments', help="show comments",
+                     action='store_true')
+    _add_repo_list_arguments(cmd, 'pull requests')
+    cmd.add_argument('--author', type=str,
+                     help='only list requests from AUTHOR')
+    cmd.add_argument('--branch', type=str,
+                     help='only list requests into BRANCH')
+    cmd.add_argument('--offline', '--from-index', action='store_true',
+                     help='answer from the local index made by gizz sync')
+    cmd.add_argument('id', type=int, help='list request #id',
+                     default=None, nargs='?')
+
+def _add_fetch_pr_arguments(cmd):
+    cmd.add_argument('--repo', type=str, help='fetch request from REPO')
+    cmd.add_argument('-m', '--merge', help="automerge pull request",
+                     action='store_true')
+    cmd.add_argument('-a', '--add-remotes',
+                     help="add each contributor's repo as a remote and fetch "
+                     "from it",
+                     action='store_true')
+    cmd.add_argument('-j', '--jobs', type=int, default=8,
+                     help='number of concurrent fetches (default: 8)')
+    cmd.add_argument('--timeout', type=int, default=60, metavar='SECONDS',
+                     help='how long to wait for GitHub to work out whether '
+                     'requests can be merged (default: 60)')
+    cmd.add_argument('id', type=int, help='fetch (or merge) request #id',
+                     nargs='*')
+
+def _add_sync_arguments(cmd):
+    cmd.add_argument('--repo', type=str, help='sync pull requests of REPO')
+
+def _add_request_pull_arguments(cmd):
+    cmd.add_argument('-r', '--repo', type=str, help='send request to REPO')
+    cmd.add_argument('-b', '--base', type=str,
+                     help='remote branch (default: master)',
+                     default='master')
+    cmd.add_argument('-e', '--head', type=str,
+                     help='local branch (default: current branch)',
+                     default=None)
+    cmd.add_argument('-p', '--no-push',
+                     help="don't push to the remote branch",
+                     action='store_true')
+    cmd.add_argument('-f', '--no-fork',
+                     help="don't fork the parent repo",
+                     action='store_true')
+
+def _add_completion_arguments(cmd):
+    pass
+
+def _add_daemon_arguments(cmd):
+    cmd.add_argument('--stop', help='stop the running daemon',
+                     action='store_true')
+    cmd.add_argument('--idle-timeout', type=int, default=3600,
+                     metavar='SECONDS',
+                     help='exit after SECONDS without a request, or never if '
+                     '0 (default: 3600)')
+    cmd.add_argument('--session-ttl', type=int, default=60,
+                     metavar='SECONDS',
+                     help='reload repositories and git configuration after '
+                     'SECONDS (default: 60)')
+
+# subcommand -> (module, class, help, function adding its arguments)
+# the module is only imported when the subcommand is run, so --help and shell
+# completion never load the networking code
+COMMANDS = {
+    'list-repos': ('gizz.builtins', 'Cmd_ListRepos',
+                   'list the user\'s repos', _add_list_repos_arguments),
+    'list-branches': ('gizz.builtins', 'Cmd_ListBranches',
+                      'list branches of a repo',
+                      _add_list_branches_arguments),
+    'list-tags': ('gizz.builtins', 'Cmd_ListTags',
+                  'list tags of a repo', _add_list_tags_arguments),
+    'download-tag': ('gizz.builtins', 'Cmd_DownloadTag',
+                     'download the source archives of tags',
+                     _add_download_tag_arguments),
+    'fork': ('gizz.builtins', 'Cmd_Fork',
+             'fork a repo', _add_fork_arguments),
+    'list-pr': ('gizz.builtins', 'Cmd_ListPullRequests',
+                'list pull requests of a repo', _add_list_pr_arguments),
+    'fetch-pr': ('gizz.builtins', 'Cmd_FetchPullRequest',
+                 'fetch a pull request into a local branch',
+                 _add_fetch_pr_arguments),
+    'sync': ('gizz.builtins', 'Cmd_Sync',
+             'mirror pull requests and comments into the local index',
+             _add_sync_arguments),
+    'request-pull': ('gizz.builtins', 'Cmd_RequestPull',
+                     'create a pull request on GitHub',
+                     _add_request_pull_arguments),
+    'completion': ('gizz.completion', 'Cmd_Completion',
+                   'print a bash completion script',
+                   _add_completion_arguments),
+    'daemon': ('gizz.daemon', 'Cmd_Daemon',
+               'keep connections and caches warm for other invocations',
+               _add_daemon_arguments),
+}
+
+# commands that set up everything they need themselves
+_LOCAL_COMMANDS = ('completion', 'daemon')
+
+# commands that only read from GitHub and can be handed to a running daemon
+_DAEMON_COMMANDS = ('list-repos', 'list-branches', 'list-tags', 'list-pr',
+                    'sync')
 
 # a factory to get the correct Command object based on the user input.
 def get_command(subcommand, args):
-    if subcommand == 'list-branches':
-        return Cmd_ListBranches(args)
-    elif subcommand == 'list-tags':
-        return Cmd_ListTags(args)
-    elif subcommand == 'fetch-pr':
-        return Cmd_FetchPullRequest(args)
-    elif subcommand == 'list-repos':
-        return Cmd_ListRepos(args)
-    elif subcommand == 'list-pr':
-        return Cmd_ListPullRequests(args)
-    elif subcommand == 'fork':
-        return Cmd_Fork(args)
-    elif subcommand == 'request-pull':
-        return Cmd_RequestPull(args)
-    else:
-        pass
-        # TODO
+    module_name, class_name, _, _ = COMMANDS[subcommand]
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)(args)
 
-def run():
+def find_subcommand(argv):
+    options_with_values = ('--trace',)
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in options_with_values:
+            skip = True
+        elif not arg.startswith('-'):
+            return arg if arg in COMMANDS else None
+    return None
+
+def build_parser(subcommand=None):
+    # only the arguments of the given subcommand are added, or those of all
+    # of them if it is None
     parser = argparse.ArgumentParser(prog='gizz')
+    parser.add_argument('--no-cache', help="don't use the response cache",
+                        action='store_true')
+    parser.add_argument('--no-daemon', help="don't use a running daemon",
+                        action='store_true',
+                        default='GIZZ_NO_DAEMON' in os.environ)
+    parser.add_argument('--trace', type=str, metavar='FILE',
+                        help='write a trace of API requests and git commands '
+                        'to FILE (default: $GIZZ_TRACE)',
+                        default=os.environ.get('GIZZ_TRACE'))
     subparsers = parser.add_subparsers(dest='subcommand',
                                        help='choose a subcommand')
 
-    cmd_list_repos = subparsers.add_parser('list-repos',
-                                           help='list the user\'s repos')
-    cmd_list_repos.add_argument('user', type=str, help='list for user',
-                                default=None, nargs='?')
-
-    cmd_list_branches = subparsers.add_parser('list-branches',
-                                              help='list branches of a repo')
-    cmd_list_branches.add_argument('--repo', type=str,
-                                   help='list branches of REPO')
-
-    cmd_list_tags = subparsers.add_parser('list-tags',
-                                          help='list tags of a repo')
-    cmd_list_tags.add_argument('--repo', type=str,
-                               help='list tags of REPO')
-
-    cmd_fork = subparsers.add_parser('fork', help='fork a repo')
-    cmd_fork.add_argument('-n', '--no-add',
-                          help="don't add new repository as a remote",
-                          action='store_true')
-    cmd_fork.add_argument('--repo', type=str,
-                               help='fork REPO')
-
-    cmd_list_pr = subparsers.add_parser('list-pr',
-                                        help='list pull requests of a repo')
-    cmd_list_pr.add_argument('-v', '--verbose', help='more details',
-                             action='store_true')
-    cmd_list_pr.add_argument('--closed', help="list closed requests",
-                             action='store_true')
-    cmd_list_pr.add_argument('-c', '--comments', help="show comments",
-                                action='store_true')
-    cmd_list_pr.add_argument('--repo', type=str,
-                             help='list pull requests of REPO')
-    cmd_list_pr.add_argument('id', type=int, help='list request #id',
-                              default=None, nargs='?')
-
-    cmd_fetch_pr = subparsers.add_parser('fetch-pr',
-                                         help='fetch a pull request into a '
-                                         'local branch')
-    cmd_fetch_pr.add_argument('--repo', type=str,
-                              help='fetch request from REPO')
-    cmd_fetch_pr.add_argument('-m', '--merge', help="automerge pull request",
-                              action='store_true')
-    cmd_fetch_pr.add_argument('id', type=int, help='fetch request #id',
-                              default=None, nargs='?')
-
-    cmd_req_pull = subparsers.add_parser('request-pull',
-                                         help='create a pull request on GitHub')
-    cmd_req_pull.add_argument('-r', '--repo', type=str,
-                              help='send request to REPO')
-    cmd_req_pull.add_argument('-b', '--base', type=str,
-                              help='remote branch (default: master)',
-                              default='master')
-    cmd_req_pull.add_argument('-e', '--head', type=str,
-                              help='local branch (default: current branch)',
-                              default=None)
-    cmd_req_pull.add_argument('-p', '--no-push',
-                              help="don't push to the remote branch",
-                              action='store_true')
-    cmd_req_pull.add_argument('-f', '--no-fork',
-                              help="don't fork the parent repo",
-                              action='store_true')
+    cmd_parsers = {}
+    for name, (_, _, help, add_arguments) in COMMANDS.items():
+        cmd_parsers[name] = subparsers.add_parser(name, help=help)
+        if subcommand is None or subcommand == name:
+            add_arguments(cmd_parsers[name])
+    return parser, cmd_parsers
+
+def run_command(command):
+    from gizz.utils import UnknownUserException, NoAuthTokenException
 
-    args = parser.parse_args()
-    command = get_command(args.subcommand, args)
-    set_auth(AuthTokenAuthorizer())
     try:
         command.run()
+    except BrokenPipeError:
+        raise
     except UnknownUserException as e:
         print('''You need to configure your username. To do that, run:
   git config --global gizz.username <username>''', file=sys.stderr)
@@ -120,3 +234,52 @@ Then run:
   git config --global gizz.authtoken <token>''', file=sys.stderr)
     except Exception as e:
         print(e, file=sys.stderr)
+
+def _run():
+    if sys.argv[1:2] == ['--complete']:
+        import gizz.completion
+        gizz.completion.complete(sys.argv[2:])
+        return
+
+    parser, _ = build_parser(find_subcommand(sys.argv[1:]))
+    args = parser.parse_args()
+    if args.subcommand is None:
+        parser.print_usage(sys.stderr)
+        sys.exit(2)
+    if args.subcommand in _DAEMON_COMMANDS and not args.no_daemon:
+        import gizz.daemon
+        status = gizz.daemon.run_in_daemon(sys.argv[1:], args)
+        if status is not None:
+            sys.exit(status)
+    command = get_command(args.subcommand, args)
+    if args.subcommand in _LOCAL_COMMANDS:
+        command.run()
+        return
+
+    from gizz.utils import set_auth, AuthTokenAuthorizer, get_cache_path
+    from gizz.trace import Tracer, get_tracer, set_tracer
+    import gizz.ghlib
+    from gizz.cache import ResponseCache
+
+    if args.trace:
+        set_tracer(Tracer(args.trace))
+    set_auth(AuthTokenAuthorizer())
+    if not args.no_cache:
+        gizz.ghlib.set_cache(ResponseCache(get_cache_path()))
+    try:
+        run_command(command)
+    finally:
+        tracer = get_tracer()
+        if tracer is not None:
+            tracer.write()
+            print(tracer.get_summary(), file=sys.stderr)
+
+def run():
+    try:
+        _run()
+    except BrokenPipeError:
+        # whatever was reading the output has exited, e.g. gizz list-pr |
+        # head; point stdout at /dev/null so that flushing it at exit doesn't
+        # fail again
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
@@ -0,0 +1,99 @@
+# Copyright 2012 Ross Lagerwall
+# This file is part of gizz.
+
+# gizz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# gizz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with gizz.  If not, see <http://www.gnu.org/licenses/>.
+
+# Machine readable output for the listing commands. Each record is a dict
+# with the fields given when the writer is made, and is written out in one
+# go and flushed as soon as it is available, so that a reader like jq can
+# start on it straight away.
+
+import json
+import sys
+
+class RecordWriter:
+
+    def __init__(self, fields, file=None):
+        self._fields = fields
+        self._file = file if file is not None else sys.stdout
+
+    def _write(self, text):
+        self._file.write(text)
+        self._file.flush()
+
+    def close(self):
+        pass
+
+
+class NdjsonWriter(RecordWriter):
+
+    # one JSON object per line
+
+    def write(self, record):
+        self._write(json.dumps(record) + '\n')
+
+
+class JsonWriter(RecordWriter):
+
+    # a single JSON array, written an element at a time
+
+    def __init__(self, fields, file=None):
+        RecordWriter.__init__(self, fields, file)
+        self._separator = '[\n'
+
+    def write(self, record):
+        self._write(self._separator + json.dumps(record))
+        self._separator = ',\n'
+
+    def close(self):
+        if self._separator == '[\n':
+            self._write('[]\n')
+        else:
+            self._write('\n]\n')
+
+
+class TsvWriter(RecordWriter):
+
+    # a header line with the field names followed by a line per record;
+    # lists are written as JSON
+
+    _escapes = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n',
+                              '\r': '\\r'})
+
+    def __init__(self, fields, file=None):
+        RecordWriter.__init__(self, fields, file)
+        self._write('\t'.join(fields) + '\n')
+
+    def _format_value(self, value):
+        if value is None:
+            return ''
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, (list, dict)):
+            value = json.dumps(value)
+        return str(value).translate(self._escapes)
+
+    def write(self, record):
+        self._write('\t'.join(self._format_value(record.get(field))
+                              for field in self._fields) + '\n')
+
+
+_WRITERS = {
+    'ndjson': NdjsonWriter,
+    'json': JsonWriter,
+    'tsv': TsvWriter,
+}
+
+def get_record_writer(format, fields, file=None):
+    return _WRITERS[format](fields, file)
@@ -0,0 +1,130 @@
+# Copyright 2012 Ross Lagerwall
+# This file is part of gizz.
+
+# gizz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# gizz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with gizz.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import threading
+import time
+from gizz.utils import RateLimitException
+
+class RateLimiter:
+
+    # Paces requests with a token bucket and keeps track of the request
+    # budget reported by GitHub in the X-RateLimit-* headers. When the budget
+    # runs low, the rate is lowered so that what is left lasts until the
+    # reset time. The defaults keep under GitHub's secondary limit of 900
+    # requests per minute: no minute can have more than the burst plus 60
+    # seconds' worth at the steady rate, 60 + 14 * 60 = 900.
+
+    def __init__(self, rate=14.0, burst=60, low_water=0.1, max_wait=900):
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._low_water = low_water
+        self.max_wait = max_wait
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.requests = 0
+        self.retries = 0
+        self.waited = 0.0
+
+    def _get_rate(self):
+        if self.remaining is None or self.reset is None or not self.limit:
+            return self._rate
+        if self.remaining > self.limit * self._low_water:
+            return self._rate
+        window = max(self.reset - time.time(), 1.0)
+        return max(min(self._rate, self.remaining / window), 1.0 / window)
+
+    def acquire(self):
+        # block until the next request may be sent
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def reserve(self):
+        # takes a token and returns how long to wait before sending the
+        # request, for callers that can't block; raises RateLimitException
+        # if that would be longer than max_wait
+        with self._lock:
+            if self.remaining == 0 and self.reset is not None:
+                # nothing is left until the reset, which may be up to an
+                # hour away
+                reset_wait = self.reset - time.time()
+                if reset_wait > self.max_wait:
+                    raise RateLimitException()
+            else:
+                reset_wait = 0.0
+            now = time.monotonic()
+            rate = self._get_rate()
+            self._tokens = min(self._burst,
+                               self._tokens + (now - self._last) * rate)
+            self._last = now
+            self._tokens -= 1
+            delay = -self._tokens / rate if self._tokens < 0 else 0.0
+            delay = max(delay, reset_wait)
+            self.requests += 1
+            self.waited += max(delay, 0.0)
+        return delay
+
+    def update(self, headers):
+        try:
+            limit = int(headers['X-RateLimit-Limit'])
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset = int(headers['X-RateLimit-Reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self._lock:
+            if self.reset is not None and reset == self.reset:
+                # responses may arrive out of order
+                remaining = min(remaining, self.remaining)
+            self.limit, self.remaining, self.reset = limit, remaining, reset
+
+    def get_retry_delay(self, status, headers, body, attempt):
+        # returns how long to wait before retrying a request that was
+        # rejected for exceeding a rate limit, or None if it wasn't
+        if status not in (403, 429):
+            return None
+        retry_after = headers.get('Retry-After')
+        if retry_after is not None and retry_after.isdigit():
+            delay = int(retry_after)
+        elif (headers.get('X-RateLimit-Remaining') == '0' and
+              headers.get('X-RateLimit-Reset', '').isdigit()):
+            delay = int(headers['X-RateLimit-Reset']) - time.time() + 1
+        elif status == 429 or b'rate limit' in body.lower():
+            # secondary rate limit without a hint, back off exponentially
+            delay = min(60.0 * 2 ** attempt, self.max_wait)
+        else:
+            # a 403 for some other reason
+            return None
+        delay = max(delay, 1.0) * random.uniform(1.0, 1.25)
+        if delay > self.max_wait:
+            raise RateLimitException()
+        with self._lock:
+            self.retries += 1
+            self.waited += delay
+        return delay
+
+    def get_stats(self):
+        with self._lock:
+            return {'limit': self.limit,
+                    'remaining': self.remaining,
+                    'reset': self.reset,
+                    'requests': self.requests,
+                    'retries': self.retries,
+                    'waited': self.waited}
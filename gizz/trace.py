@@ -0,0 +1,89 @@
+# Copyright 2012 Ross Lagerwall
+# This file is part of gizz.
+
+# gizz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# gizz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with gizz.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+_tracer = None
+
+def set_tracer(tracer):
+    global _tracer
+    _tracer = tracer
+
+def get_tracer():
+    return _tracer
+
+@contextlib.contextmanager
+def trace_span(name, cat, **args):
+    # records the enclosed block as a span; the yielded dict can be used to
+    # add details that are only known at the end
+    if _tracer is None:
+        yield args
+        return
+    start = time.perf_counter()
+    try:
+        yield args
+    finally:
+        _tracer.add(name, cat, start, time.perf_counter(), args)
+
+
+class Tracer:
+
+    # Collects spans and writes them out in the Chrome trace event format,
+    # which can be loaded in chrome://tracing or Perfetto.
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._events = []
+        self._start = time.perf_counter()
+        self._pid = os.getpid()
+
+    def add(self, name, cat, start, end, args):
+        event = {'name': name,
+                 'cat': cat,
+                 'ph': 'X',
+                 'ts': (start - self._start) * 1e6,
+                 'dur': (end - start) * 1e6,
+                 'pid': self._pid,
+                 'tid': threading.get_ident(),
+                 'args': args}
+        with self._lock:
+            self._events.append(event)
+
+    def write(self):
+        with self._lock:
+            events = list(self._events)
+        with open(self._path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def get_summary(self):
+        with self._lock:
+            events = list(self._events)
+        api = [e for e in events if e['cat'] == 'api' and
+               'status' in e['args']]
+        git = [e for e in events if e['cat'] == 'git']
+        received = sum(e['args'].get('bytes_received', 0) for e in events)
+        total = time.perf_counter() - self._start
+        # the times of concurrent spans add up to more than the total
+        return ('gizz: {} API requests ({:.2f}s, {:.1f} KiB received), '
+                '{} git commands ({:.2f}s), {:.2f}s total'.format(
+                    len(api), sum(e['dur'] for e in api) / 1e6,
+                    received / 1024, len(git),
+                    sum(e['dur'] for e in git) / 1e6, total))
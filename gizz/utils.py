@@ -14,14 +14,19 @@
 # You should have received a copy of the GNU General Public License
 # along with gizz.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import concurrent.futures
 import getpass
 import os
 import subprocess
 import tempfile
+import threading
 import filecmp
 import shutil
+from gizz.trace import trace_span
 
 _auth = None
+_context = None
 
 def set_auth(auth):
     global _auth
@@ -30,6 +35,83 @@ def set_auth(auth):
 def get_auth():
     return _auth
 
+def set_context(context):
+    global _context
+    _context = context
+
+def get_context():
+    global _context
+    if _context is None:
+        _context = RepositoryContext()
+    return _context
+
+
+class RepositoryContext:
+
+    # A snapshot of the git configuration and current branch, read once per
+    # invocation instead of running git for every query.
+
+    def __init__(self):
+        self._config = None
+        self._config_lock = threading.Lock()
+        self._current_branch = None
+        self._have_current_branch = False
+
+    def _load_config(self):
+        # filled in before it is set so that other threads never see a
+        # partial configuration, and only by the first thread to need it
+        with self._config_lock:
+            if self._config is not None:
+                return
+            config = {}
+            output = git_system('config', '--list', '-z')
+            for entry in output.split('\0'):
+                if not entry:
+                    continue
+                key, _, value = entry.partition('\n')
+                config.setdefault(key, []).append(value)
+            self._config = config
+
+    def get_config(self, key, default=None):
+        if self._config is None:
+            self._load_config()
+        values = self._config.get(key)
+        return values[-1] if values else default
+
+    def get_config_all(self, key):
+        if self._config is None:
+            self._load_config()
+        return self._config.get(key, [])
+
+    def get_remote_url(self, remote_name):
+        url = self.get_config('remote.{}.url'.format(remote_name))
+        if url is None:
+            return None
+
+        # apply url.<base>.insteadOf rewrites like git does
+        best = ''
+        for key in self._config:
+            if key.startswith('url.') and key.endswith('.insteadof'):
+                for prefix in self._config[key]:
+                    if url.startswith(prefix) and len(prefix) > len(best):
+                        best = prefix
+                        base = key[len('url.'):-len('.insteadof')]
+        if best:
+            url = base + url[len(best):]
+        return url
+
+    def get_current_branch(self):
+        if not self._have_current_branch:
+            try:
+                self._current_branch = git_system('symbolic-ref', '--short',
+                                                  'HEAD').strip()
+            except subprocess.CalledProcessError:
+                # detached HEAD
+                self._current_branch = None
+            self._have_current_branch = True
+        return self._current_branch
+
+
 class AuthTokenAuthorizer:
 
     def __init__(self):
@@ -38,20 +120,16 @@ class AuthTokenAuthorizer:
 
     def get_username(self):
         if self._username is None:
-
-            try:
-                self._username = git_system('config', 'gizz.username').strip()
-            except subprocess.CalledProcessError as e:
+            self._username = get_context().get_config('gizz.username')
+            if self._username is None:
                 raise UnknownUserException()
 
         return self._username
 
     def get_auth_token(self):
         if self._auth_token is None:
-
-            try:
-                self._auth_token = git_system('config', 'gizz.authtoken').strip()
-            except subprocess.CalledProcessError as e:
+            self._auth_token = get_context().get_config('gizz.authtoken')
+            if self._auth_token is None:
                 raise NoAuthTokenException()
 
         return self._auth_token
@@ -102,6 +180,53 @@ class InvalidRepositoryException(Exception):
         return 'Invalid repository: ' + self.msg
 
 
+class ApiException(Exception):
+
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return 'GitHub API error: ' + self.msg
+
+
+class NetworkException(Exception):
+
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return 'Could not reach GitHub: ' + self.msg
+
+
+class DownloadException(Exception):
+
+    def __init__(self, path, msg):
+        self.path = path
+        self.msg = msg
+
+    def __str__(self):
+        return 'Failed to download {}: {}'.format(self.path, self.msg)
+
+
+class RateLimitException(Exception):
+
+    def __init__(self):
+        pass
+
+    def __str__(self):
+        return 'GitHub API rate limit exceeded, try again later'
+
+
+class NotSyncedException(Exception):
+
+    def __init__(self, repo):
+        self.repo = repo
+
+    def __str__(self):
+        return ('{} has not been synced, run gizz sync first'.format(
+                self.repo))
+
+
 class MessageGetter:
 
     def __init__(self):
@@ -158,14 +283,104 @@ class TitledMessageGetter(MessageGetter):
 def git_system(*args):
     cmdline = ['git']
     cmdline.extend(args)
-    with open(os.devnull, 'wb') as null:
-        return subprocess.check_output(cmdline, stderr=null).decode()
+    with trace_span('git ' + args[0], 'git', argv=cmdline) as span:
+        with open(os.devnull, 'wb') as null:
+            output = subprocess.check_output(cmdline, stderr=null)
+        span['bytes_output'] = len(output)
+        return output.decode()
 
-def git_run(*args):
+def git_run(*args, input=None):
     cmdline = ['git']
     cmdline.extend(args)
-    with open(os.devnull, 'wb') as null:
-        subprocess.check_call(cmdline, stdout=null, stderr=null)
+    with trace_span('git ' + args[0], 'git', argv=cmdline):
+        subprocess.run(cmdline, input=input, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=True)
+
+
+class GitRefs:
+
+    # A snapshot of the repository's refs, read with a single for-each-ref,
+    # for picking free branch names without running git for each name tried.
+    # Branches created with create_branch() are written together in one
+    # update-ref transaction by commit().
+
+    def __init__(self):
+        self._refs = {}
+        # the directories refs are in, which can't be refs themselves
+        self._dirs = set()
+        self._updates = []
+        output = git_system('for-each-ref', '--format=%(objectname) %(refname)')
+        for line in output.splitlines():
+            sha, _, ref = line.partition(' ')
+            self._add(ref, sha)
+
+    def _add(self, ref, sha):
+        self._refs[ref] = sha
+        parts = ref.split('/')
+        for i in range(1, len(parts)):
+            self._dirs.add('/'.join(parts[:i]))
+
+    def get(self, ref):
+        return self._refs.get(ref)
+
+    def _is_free(self, ref):
+        if ref in self._refs or ref in self._dirs:
+            return False
+        parts = ref.split('/')
+        return not any('/'.join(parts[:i]) in self._refs
+                       for i in range(1, len(parts)))
+
+    def pick_branch_name(self, names):
+        # returns the first of names that isn't taken, reserving it so that
+        # it isn't picked again
+        for name in names:
+            if self._is_free('refs/heads/' + name):
+                self._add('refs/heads/' + name, None)
+                return name
+
+    def create_branch(self, name, sha):
+        self._updates.append('create refs/heads/{} {}\n'.format(name, sha))
+        self._add('refs/heads/' + name, sha)
+
+    def commit(self):
+        if self._updates:
+            git_run('update-ref', '--stdin',
+                    input=''.join(self._updates).encode())
+            self._updates = []
+
+def git_fetch_remotes(remotes, jobs):
+    # fetch several remotes, running up to jobs fetches at a time; yields
+    # (remote, error) as each fetch completes with error being None if the
+    # fetch succeeded
+    def fetch(remote):
+        cmdline = ['git', 'fetch', remote]
+        with trace_span('git fetch', 'git', argv=cmdline) as span:
+            with subprocess.Popen(cmdline, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.PIPE) as p:
+                _, err = p.communicate()
+            span['status'] = p.returncode
+        if p.returncode != 0:
+            err = err.decode(errors='replace').strip()
+            return remote, err.split('\n')[0] if err else 'fetch failed'
+        return remote, None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(fetch, remote) for remote in remotes]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+def ordered_map(func, iterable, jobs):
+    # like map() but calls func from up to jobs threads at a time; results
+    # are yielded in the order of iterable, which is consumed only as far as
+    # needed to keep the workers busy
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= jobs * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 # Returns ~/.config/gizz/config in the usual case
 def get_config_path():
@@ -176,3 +391,9 @@ def get_config_path():
     config_dir = os.path.join(config_home, 'gizz')
     os.makedirs(config_dir, exist_ok=True)
     return os.path.join(config_dir, 'config')
+
+def get_cache_path():
+    return os.path.join(os.path.dirname(get_config_path()), 'cache')
+
+def get_index_path():
+    return os.path.join(os.path.dirname(get_config_path()), 'index.sqlite')